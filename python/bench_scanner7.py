@@ -0,0 +1,279 @@
+"""
+Benchmarks for scanner7.py.
+
+Run from the python/ directory against real sheet photos, e.g.
+
+    python bench_scanner7.py detectors uploads/*.jpg --repeat 3
+    python bench_scanner7.py decimation uploads/*.jpg
+    python bench_scanner7.py memory uploads/*.jpg
+    python bench_scanner7.py decode uploads/*.jpg
+    python bench_scanner7.py regions uploads/*.jpg
+    python bench_scanner7.py qr uploads/*.jpg
+    python bench_scanner7.py imports            # fails when over import_budget.json
+    python bench_scanner7.py imports --update   # re-baseline the budget
+"""
+import argparse
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import scanner7
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPORT_BUDGET_PATH = os.path.join(HERE, 'import_budget.json')
+# Headroom over the measured median when the budget is re-baselined
+IMPORT_BUDGET_HEADROOM = 1.25
+
+
+def time_ms(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    mean = sum(timings) / len(timings)
+    print(f"{label:<28} mean {mean:8.1f} ms   median {timings[len(timings) // 2]:8.1f} ms   n={len(timings)}")
+    return mean
+
+
+def bench_detectors(images, repeat):
+    """Per-sheet locate cost with a new AprilTag detector per call vs the shared one"""
+    decoded = [scanner7.read_local_image(path) for path in images]
+    scanner7.locate_sheet(decoded[0])  # warm up imports and lazily built state
+
+    # Old detectors are kept alive until the end so the fresh timings cover
+    # building and using a detector, not tearing the previous one down
+    retired = []
+    fresh = []
+    for _ in range(repeat):
+        for image in decoded:
+            retired.append(getattr(scanner7._detectors, 'apriltag', None))
+            scanner7._detectors.apriltag = {}
+            fresh.append(time_ms(scanner7.locate_sheet, image))
+
+    shared = [time_ms(scanner7.locate_sheet, image) for _ in range(repeat) for image in decoded]
+
+    fresh_mean = report("new detector per sheet", fresh)
+    shared_mean = report("shared detector", shared)
+    print(f"saving per sheet: {fresh_mean - shared_mean:.1f} ms")
+
+
+def bench_decimation(images, repeat):
+    """Tag detection time and corner accuracy of the coarse-to-fine pass vs full resolution"""
+    grays = [cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in images]
+    scanner7.locate_tags(grays[0])  # warm up imports and the detector
+
+    full_timings, coarse_timings, deviations = [], [], []
+    for path, gray in zip(images, grays):
+        full = scanner7.locate_tags(gray, coarse=False)
+        coarse = scanner7.locate_tags(gray)
+        shared = set(full) & set(coarse)
+        deviation = max((float(np.abs(full[i] - coarse[i]).max()) for i in shared), default=float('nan'))
+        deviations.append(deviation)
+        print(f"{path}: 1/{scanner7.coarse_decimation(gray.shape)}, tags full {sorted(full)} coarse {sorted(coarse)}, "
+              f"max corner deviation {deviation:.2f} px")
+        full_timings += [time_ms(scanner7.locate_tags, gray, False) for _ in range(repeat)]
+        coarse_timings += [time_ms(scanner7.locate_tags, gray) for _ in range(repeat)]
+
+    full_mean = report("full resolution", full_timings)
+    coarse_mean = report("coarse to fine", coarse_timings)
+    print(f"speedup: {full_mean / coarse_mean:.2f}x   worst corner deviation: {np.nanmax(deviations):.2f} px")
+
+
+def bench_memory(images, repeat):
+    """Peak memory and warp latency of the grayscale pipeline vs decoding and warping in color"""
+    scanner7.locate_sheet(images[0])  # warm up imports and the detector
+
+    for label, flags in (("color decode and warp", cv2.IMREAD_COLOR), ("grayscale pipeline", cv2.IMREAD_GRAYSCALE)):
+        peaks, warps = [], []
+        for path in images:
+            for _ in range(repeat):
+                # numpy reports the arrays OpenCV returns to tracemalloc, which
+                # covers the decoded, warped and two-tone images
+                tracemalloc.start()
+                image = scanner7.read_local_image(path, flags)
+                result, warped = scanner7.locate_sheet(image)
+                scanner7.read_answers(scanner7.convert_to_two_tone(warped), result)
+                peaks.append(tracemalloc.get_traced_memory()[1] / 2 ** 20)
+                tracemalloc.stop()
+                del image, warped
+                warps.append(time_ms(scanner7.warp_image_apriltag, scanner7.read_local_image(path, flags)))
+        print(f"{label}: peak {statistics.mean(peaks):.1f} MiB")
+        report("  warp_image_apriltag", warps)
+
+
+def bench_decode(images, repeat):
+    """locate_sheet() from the path, with decode sizes picked from the header, vs a full-resolution decode first"""
+    scanner7.locate_sheet(images[0])  # warm up imports and the detector
+
+    full_timings, reduced_timings = [], []
+    for path in images:
+        size = scanner7.image_size(scanner7.read_image_bytes(path))
+        full = [time_ms(lambda: scanner7.locate_sheet(scanner7.read_local_image(path))) for _ in range(repeat)]
+        reduced = [time_ms(scanner7.locate_sheet, path) for _ in range(repeat)]
+        factors = f"detect 1/{scanner7.detection_reduction(size)}, warp 1/{scanner7.warp_reduction(size)}" if size else "unknown size"
+        print(f"{path}: {size}, {factors}, full {statistics.mean(full):.1f} ms, reduced {statistics.mean(reduced):.1f} ms")
+        full_timings += full
+        reduced_timings += reduced
+
+    full_mean = report("full-resolution decode", full_timings)
+    reduced_mean = report("reduced decodes", reduced_timings)
+    print(f"speedup: {full_mean / reduced_mean:.2f}x")
+
+
+def bench_regions(images, repeat):
+    """Warp and bubble reading cost of the whole page vs only the answer ROIs, for grading without a corrected image"""
+    grays = [scanner7.read_local_image(path) for path in images]
+    located = [(gray, scanner7.locate_tags(gray)) for gray in grays]
+
+    def read(gray, tags, answers_only):
+        result = scanner7.ScanResult()
+        warped, result.paper_size = scanner7.warp_located_sheet(gray, tags, answers_only=answers_only)
+        scanner7.read_answers(scanner7.convert_to_two_tone(warped), result)
+
+    for label, answers_only in (("whole page", False), ("answer ROIs only", True)):
+        peaks, timings = [], []
+        for gray, tags in located:
+            for _ in range(repeat):
+                tracemalloc.start()
+                read(gray, tags, answers_only)
+                peaks.append(tracemalloc.get_traced_memory()[1] / 2 ** 20)
+                tracemalloc.stop()
+                timings.append(time_ms(read, gray, tags, answers_only))
+        print(f"{label}: peak {statistics.mean(peaks):.1f} MiB")
+        report("  warp and read", timings)
+
+
+def bench_qr(images, repeat):
+    """QR decoding from the whole reduced photo vs from the layout's qr_boxes cut out through the tag transform"""
+    whole_timings, crop_timings = [], []
+    for path in images:
+        image_bytes = scanner7.read_image_bytes(path)
+        size = scanner7.image_size(image_bytes)
+        small = scanner7.decode_image(image_bytes, scanner7.detection_reduction(size) if size else 1)
+        transform = scanner7.tag_transform(scanner7.locate_tags(small))
+        if transform is None:
+            print(f"{path}: tags do not place the sheet, skipped")
+            continue
+        whole = scanner7.detect_qr_code(small)
+        crop = scanner7.read_sheet_qr(small, transform)
+        print(f"{path}: {transform[1]}, whole photo {whole!r}, qr_boxes {crop!r}")
+        whole_timings += [time_ms(scanner7.detect_qr_code, small) for _ in range(repeat)]
+        crop_timings += [time_ms(scanner7.read_sheet_qr, small, transform) for _ in range(repeat)]
+
+    if not crop_timings:
+        return
+    whole_mean = report("whole photo", whole_timings)
+    crop_mean = report("qr_boxes", crop_timings)
+    print(f"speedup: {whole_mean / crop_mean:.2f}x")
+
+
+def import_profile():
+    """Cold import of scanner7 in a fresh interpreter: (total ms, {direct import: cumulative ms})"""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import scanner7'],
+        cwd=HERE, capture_output=True, text=True, check=True,
+    )
+    total, direct = None, {}
+    # Lines look like "import time:  self [us] | cumulative | <indent>module"
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        _, cumulative, name = line.split('|')
+        if name.strip() == 'scanner7':
+            total = int(cumulative) / 1000
+        elif name.startswith('   ') and not name.startswith('    '):
+            direct[name.strip()] = int(cumulative) / 1000
+    return total, direct
+
+
+def bench_imports(repeat, update):
+    """Cold-start import time of scanner7 checked against the stored budget"""
+    profiles = [import_profile() for _ in range(repeat)]
+    totals = [total for total, _ in profiles]
+    median = statistics.median(totals)
+
+    report("import scanner7", totals)
+    heaviest = sorted(profiles[-1][1].items(), key=lambda item: -item[1])[:8]
+    for name, cumulative in heaviest:
+        print(f"  {name:<26} {cumulative:8.1f} ms")
+
+    if update:
+        budget = math.ceil(median * IMPORT_BUDGET_HEADROOM)
+        with open(IMPORT_BUDGET_PATH, 'w') as f:
+            json.dump({'scanner7_import_ms': budget}, f, indent=2)
+            f.write('\n')
+        print(f"budget set to {budget} ms")
+        return
+
+    with open(IMPORT_BUDGET_PATH) as f:
+        budget = json.load(f)['scanner7_import_ms']
+    print(f"budget {budget} ms")
+    if median > budget:
+        sys.exit(f"import time {median:.1f} ms is over the {budget} ms budget")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    detectors = subparsers.add_parser('detectors', help=bench_detectors.__doc__)
+    detectors.add_argument('images', nargs='+')
+    detectors.add_argument('--repeat', type=int, default=3)
+
+    decimation = subparsers.add_parser('decimation', help=bench_decimation.__doc__)
+    decimation.add_argument('images', nargs='+')
+    decimation.add_argument('--repeat', type=int, default=3)
+
+    memory = subparsers.add_parser('memory', help=bench_memory.__doc__)
+    memory.add_argument('images', nargs='+')
+    memory.add_argument('--repeat', type=int, default=3)
+
+    decode = subparsers.add_parser('decode', help=bench_decode.__doc__)
+    decode.add_argument('images', nargs='+')
+    decode.add_argument('--repeat', type=int, default=3)
+
+    regions = subparsers.add_parser('regions', help=bench_regions.__doc__)
+    regions.add_argument('images', nargs='+')
+    regions.add_argument('--repeat', type=int, default=3)
+
+    qr = subparsers.add_parser('qr', help=bench_qr.__doc__)
+    qr.add_argument('images', nargs='+')
+    qr.add_argument('--repeat', type=int, default=3)
+
+    imports = subparsers.add_parser('imports', help=bench_imports.__doc__)
+    imports.add_argument('--repeat', type=int, default=5)
+    imports.add_argument('--update', action='store_true', help="Store the measured time plus headroom as the new budget")
+
+    args = parser.parse_args()
+    # Benchmark runs should not skew the deployment's preprocessing order
+    scanner7.DETECTION_STATS_PATH = None
+
+    if args.benchmark == 'detectors':
+        bench_detectors(args.images, args.repeat)
+    elif args.benchmark == 'decimation':
+        bench_decimation(args.images, args.repeat)
+    elif args.benchmark == 'memory':
+        bench_memory(args.images, args.repeat)
+    elif args.benchmark == 'decode':
+        bench_decode(args.images, args.repeat)
+    elif args.benchmark == 'regions':
+        bench_regions(args.images, args.repeat)
+    elif args.benchmark == 'qr':
+        bench_qr(args.images, args.repeat)
+    elif args.benchmark == 'imports':
+        bench_imports(args.repeat, args.update)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Success statistics for the preprocessing cascade used before tag detection.
+
+Each deployment sees its own kind of photos: one school scans on a copier
+and the raw grayscale image always works, another takes phone pictures in
+a dim classroom and mostly needs histogram equalization. Counting how
+often each variant led to a detection lets the scanner try the one most
+likely to work first instead of always paying for the misses.
+
+Counts are kept per detection pass (a variant that rescues a decimated
+image is not necessarily the one that rescues the full-resolution photo)
+and live in a small JSON file. Outcomes are collected in memory and merged
+into the file under an exclusive lock every FLUSH_INTERVAL seconds and at
+exit, so batch workers sharing a path never lose each other's updates and
+no sheet waits on the file.
+"""
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+
+# Seconds between merging the collected outcomes into the file
+FLUSH_INTERVAL = 60
+
+
+class CascadeStats:
+    """
+    Attempt and success counts per detection pass and variant, persisted to path.
+
+    With path=None the counts are only kept in memory for this process.
+    """
+
+    def __init__(self, path, default_order):
+        self.path = path
+        self.default_order = list(default_order)
+        self.counts = None
+        self._unsaved = {}
+        self._saved_at = time.monotonic()
+        self._lock = threading.Lock()
+        if path is not None:
+            atexit.register(self.flush)
+
+    def order(self, pass_name):
+        """Variant names for one pass, the best smoothed success rate first and the default order breaking ties"""
+        with self._lock:
+            if self.counts is None:
+                self.counts = self._load()
+            counts = self.counts.get(pass_name, {})
+
+        def rate(name):
+            attempts, successes = counts.get(name, (0, 0))
+            return (successes + 1) / (attempts + 2)
+
+        rank = {name: index for index, name in enumerate(self.default_order)}
+        return sorted(self.default_order, key=lambda name: (-rate(name), rank[name]))
+
+    def record(self, pass_name, outcomes):
+        """Adds [(variant, succeeded), ...] from one detection pass to the counts"""
+        if not outcomes:
+            return
+        with self._lock:
+            if self.counts is None:
+                self.counts = self._load()
+            self.counts = self._merge(self.counts, pass_name, outcomes)
+            if self.path is None:
+                return
+            self._unsaved = self._merge(self._unsaved, pass_name, outcomes)
+            if time.monotonic() - self._saved_at >= FLUSH_INTERVAL:
+                self._save()
+
+    def flush(self):
+        """Merge the outcomes recorded since the last write into the file"""
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self._saved_at = time.monotonic()
+        if self.path is None or not self._unsaved:
+            return
+        with open(f"{self.path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            counts = self._load()
+            for pass_name, variants in self._unsaved.items():
+                for name, (attempts, successes) in variants.items():
+                    saved_attempts, saved_successes = counts.setdefault(pass_name, {}).get(name, (0, 0))
+                    counts[pass_name][name] = (saved_attempts + attempts, saved_successes + successes)
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump({
+                    pass_name: {name: {'attempts': a, 'successes': s} for name, (a, s) in variants.items()}
+                    for pass_name, variants in counts.items()
+                }, f, indent=2)
+            os.replace(temp_path, self.path)
+        # Pick up what other processes saved in the meantime
+        self.counts = counts
+        self._unsaved = {}
+
+    @staticmethod
+    def _merge(counts, pass_name, outcomes):
+        counts = dict(counts)
+        variants = counts[pass_name] = dict(counts.get(pass_name, {}))
+        for name, succeeded in outcomes:
+            attempts, successes = variants.get(name, (0, 0))
+            variants[name] = (attempts + 1, successes + int(succeeded))
+        return counts
+
+    def _load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+            return {
+                pass_name: {name: (int(entry['attempts']), int(entry['successes'])) for name, entry in variants.items()}
+                for pass_name, variants in stored.items()
+            }
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # Missing or unreadable stats (including the older file without
+            # passes) only cost the learned order
+            return {}
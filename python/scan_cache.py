@@ -0,0 +1,102 @@
+"""
+On-disk cache of scan results keyed by image content.
+
+Teachers often upload the same photo twice (retries after a timeout, the
+same folder dragged in again). The vision half of a scan only depends on
+the image bytes, the scanner version and the layout, so its output is kept
+in a SQLite file and a repeated upload only needs to be regraded.
+
+Entries hold a JSON metadata blob plus two binary blobs (the bubble table
+and the encoded two-tone sheet). The file is bounded by max_bytes and the
+least recently used entries are evicted first.
+"""
+import json
+import time
+from contextlib import contextmanager
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Bump when the table layout changes; older files are emptied on open
+SCHEMA_VERSION = 2
+
+
+def content_key(image_bytes, scanner_version, layout):
+    import hashlib  # loads OpenSSL, only worth it for runs that use a cache
+    digest = hashlib.sha256()
+    digest.update(f"{scanner_version}\0{layout or 'auto'}\0".encode('utf-8'))
+    digest.update(image_bytes)
+    return digest.hexdigest()
+
+
+class ScanCache:
+    """
+    Size-bounded LRU store shared by every process that opens the same path.
+
+    A connection is opened per call, so instances can be pickled into pool
+    workers and used from several threads.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                conn.execute("DROP TABLE IF EXISTS scans")
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS scans (
+                    key TEXT PRIMARY KEY,
+                    meta TEXT NOT NULL,
+                    bubbles BLOB NOT NULL,
+                    sheet BLOB,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS scans_last_used ON scans (last_used)")
+
+    @contextmanager
+    def _connect(self):
+        import sqlite3  # as above, runs without a cache never load it
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        """Returns (meta, bubbles bytes, sheet bytes) or None, and marks the entry as recently used"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT meta, bubbles, sheet FROM scans WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE scans SET last_used = ? WHERE key = ?", (time.time(), key))
+        meta, bubbles, sheet = row
+        return json.loads(meta), bubbles, sheet
+
+    def put(self, key, meta, bubbles, sheet):
+        meta = json.dumps(meta)
+        size = len(meta) + len(bubbles) + len(sheet or b'')
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO scans (key, meta, bubbles, sheet, size, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, meta, bubbles, sheet, size, time.time()),
+            )
+            self._evict(conn, keep=key)
+
+    def update_meta(self, key, meta):
+        with self._connect() as conn:
+            conn.execute("UPDATE scans SET meta = ? WHERE key = ?", (json.dumps(meta), key))
+
+    def _evict(self, conn, keep):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM scans").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM scans WHERE key != ? ORDER BY last_used", (keep,)):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM scans WHERE key = ?", stale)
@@ -1,12 +1,8 @@
 import cv2
 import sys
 import numpy as np
-import pandas as pd
 import json
-from operator import itemgetter
 import cv2.aruco as aruco
-from PIL import Image, ImageOps
-import random
 from pyzbar.pyzbar import decode
 
 global paper_size
@@ -23,7 +19,7 @@ def generate_json_output(qr_code_data):
     answer_mapping = {'A': 1, 'B': 2, 'C': 3, 'D': 4}
 
     for question_number in range(1, total_questions + 1):
-        letter_answer = df.at[question_number, 'Option']
+        letter_answer = marked_options.get(question_number, 'N')
         numeric_answer = answer_mapping.get(letter_answer, 0)
         user_answers.append(numeric_answer)
 
@@ -168,7 +164,6 @@ warped_image = warp_image(image)
 if warped_image is not None:
     two_tone_image = convert_to_two_tone(warped_image)
     final_image = two_tone_image
-    pil_image = Image.fromarray(final_image)
 
 
 def detect_circles(input_image, min_radius=0):
@@ -278,13 +273,8 @@ for roi_key, circles in detected_circles.items():
     circle_mappings[roi_key] = sort_circles_spatially(circles, roi_index)
 
 
-# Initialize dataframe
-if paper_size == 'A4':
-    df = pd.DataFrame({'Option': ['N'] * 120}, index=range(1, 121))
-elif paper_size == 'A5':
-    df = pd.DataFrame({'Option': ['N'] * 60}, index=range(1, 61))
-else:
-    df = pd.DataFrame({'Option': ['N'] * 120}, index=range(1, 121))
+# Marked option per question number, 'W' for several marks; unmarked questions are absent
+marked_options = {}
 
 filled_circles_count = {}
 
@@ -302,9 +292,9 @@ for roi_key, circle_map in circle_mappings.items():
             filled_circles_count[question_number] += 1
             
             if filled_circles_count[question_number] > 1:
-                df.at[question_number, 'Option'] = 'W'  # Multiple answers
+                marked_options[question_number] = 'W'  # Multiple answers
             else:
-                df.at[question_number, 'Option'] = option
+                marked_options[question_number] = option
 
 
 # Visualization and correction
@@ -363,7 +353,7 @@ for roi_key, circle_map in circle_mappings.items():
                                  (adjusted_x+half_square, adjusted_y+half_square), (0, 255, 255), 3)
                 else:
                     correct_answer = mapped_answers[question_number - 1]
-                    if correct_answer == df.at[question_number, 'Option']:
+                    if correct_answer == marked_options.get(question_number, 'N'):
                         # Correct answer - green rectangle
                         cv2.rectangle(final_image_color, (adjusted_x-half_square, adjusted_y-half_square), 
                                      (adjusted_x+half_square, adjusted_y+half_square), (55, 155, 55), 3)
@@ -391,7 +381,6 @@ final_image_color[upper_left[1]:lower_right[1], upper_left[0]:lower_right[0]] =
 
 # Save final image
 resized_image = cv2.resize(final_image_color, (1000, 1436))
-random_number = random.randint(1000000000, 9999999999)
 final_image_path = f'../public/uploads/corrects/{qr_code_data}.jpg'
 cv2.imwrite(final_image_path, resized_image)
 
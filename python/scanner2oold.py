@@ -1,12 +1,8 @@
 import cv2
 import sys
 import numpy as np
-import pandas as pd
 import json
-from operator import itemgetter
 import cv2.aruco as aruco
-from PIL import Image, ImageOps
-import random
 # from pyzbar.pyzbar import decode
 
 global paper_size
@@ -23,7 +19,7 @@ def generate_json_output(qr_code_data):
     answer_mapping = {'A': 1, 'B': 2, 'C': 3, 'D': 4}
 
     for question_number in range(1, total_questions + 1):
-        letter_answer = df.at[question_number, 'Option']
+        letter_answer = marked_options.get(question_number, 'N')
         numeric_answer = answer_mapping.get(letter_answer, 0)
         user_answers.append(numeric_answer)
 
@@ -115,26 +111,19 @@ def convert_to_two_tone(image):
 
 
 def enhance_marker_detection(gray_image):
-    """Apply preprocessing to improve marker detection"""
-    enhanced_images = []
-    
+    """Yield preprocessed variants to improve marker detection, each computed only when the previous one failed"""
     # Original
-    enhanced_images.append(gray_image)
+    yield gray_image
     
     # Histogram equalization
-    equalized = cv2.equalizeHist(gray_image)
-    enhanced_images.append(equalized)
+    yield cv2.equalizeHist(gray_image)
     
     # CLAHE (Contrast Limited Adaptive Histogram Equalization)
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-    clahe_img = clahe.apply(gray_image)
-    enhanced_images.append(clahe_img)
+    yield clahe.apply(gray_image)
     
     # Bilateral filter (reduces noise while keeping edges)
-    bilateral = cv2.bilateralFilter(gray_image, 9, 75, 75)
-    enhanced_images.append(bilateral)
-    
-    return enhanced_images
+    yield cv2.bilateralFilter(gray_image, 9, 75, 75)
 
 
 def warp_image_aruco(input_image):
@@ -439,7 +428,6 @@ warped_image = warp_image(image, template_path='blank_template.jpg')
 if warped_image is not None:
     two_tone_image = convert_to_two_tone(warped_image)
     final_image = two_tone_image
-    pil_image = Image.fromarray(final_image)
 
 # Detect circles in each ROI
 detected_circles = {}
@@ -455,13 +443,8 @@ for roi_key, circles in detected_circles.items():
     roi_index = int(roi_key.split('_')[-1])
     circle_mappings[roi_key] = sort_circles_spatially(circles, roi_index)
 
-# Initialize dataframe
-if paper_size == 'A4':
-    df = pd.DataFrame({'Option': ['N'] * 120}, index=range(1, 121))
-elif paper_size == 'A5':
-    df = pd.DataFrame({'Option': ['N'] * 60}, index=range(1, 61))
-else:
-    df = pd.DataFrame({'Option': ['N'] * 120}, index=range(1, 121))
+# Marked option per question number, 'W' for several marks; unmarked questions are absent
+marked_options = {}
 
 filled_circles_count = {}
 
@@ -479,9 +462,9 @@ for roi_key, circle_map in circle_mappings.items():
             filled_circles_count[question_number] += 1
             
             if filled_circles_count[question_number] > 1:
-                df.at[question_number, 'Option'] = 'W'  # Multiple answers
+                marked_options[question_number] = 'W'  # Multiple answers
             else:
-                df.at[question_number, 'Option'] = option
+                marked_options[question_number] = option
 
 # Visualization and correction
 circle_radius = 20 if paper_size == 'A4' else 25 if paper_size == 'A5' else 20
@@ -539,7 +522,7 @@ for roi_key, circle_map in circle_mappings.items():
                                  (adjusted_x+half_square, adjusted_y+half_square), (0, 255, 255), 3)
                 else:
                     correct_answer = mapped_answers[question_number - 1]
-                    if correct_answer == df.at[question_number, 'Option']:
+                    if correct_answer == marked_options.get(question_number, 'N'):
                         # Correct answer - green rectangle
                         cv2.rectangle(final_image_color, (adjusted_x-half_square, adjusted_y-half_square), 
                                      (adjusted_x+half_square, adjusted_y+half_square), (55, 155, 55), 3)
@@ -566,7 +549,6 @@ final_image_color[upper_left[1]:lower_right[1], upper_left[0]:lower_right[0]] =
 
 # Save final image
 resized_image = cv2.resize(final_image_color, (1000, 1436))
-random_number = random.randint(1000000000, 9999999999)
 final_image_path = f'../public/uploads/corrects/{qr_code_data}.jpg'
 cv2.imwrite(final_image_path, resized_image)
 
@@ -1,55 +1,326 @@
+import argparse
 import cv2
+import os
+import queue
+import struct
 import sys
+import threading
 import numpy as np
-import pandas as pd
 import json
-from operator import itemgetter
+from dataclasses import dataclass, field
+from numpy.lib.stride_tricks import sliding_window_view
 import apriltag
-from PIL import Image, ImageOps
-import random
 from pyzbar.pyzbar import decode
 
-global paper_size
-paper_size = None
-
-def generate_json_output(qr_code_data):
-    right_answers = []
-    wrong_answers = []
-    multiple_answers = []
-    un_answered = []
-    user_answers = []
-
-    total_questions = len(correct_answers)
-    answer_mapping = {'A': 1, 'B': 2, 'C': 3, 'D': 4}
-
-    for question_number in range(1, total_questions + 1):
-        letter_answer = df.at[question_number, 'Option']
-        numeric_answer = answer_mapping.get(letter_answer, 0)
-        user_answers.append(numeric_answer)
-
-        filled_count = filled_circles_count.get(question_number, 0)
-        if filled_count > 1:
-            multiple_answers.append(question_number)
-        elif filled_count == 0:
-            un_answered.append(question_number)
-        else:
-            correct_answer = mapped_answers[question_number - 1]
-            if correct_answer == letter_answer:
-                right_answers.append(question_number)
-            else:
-                wrong_answers.append(question_number)
+from cascade_stats import CascadeStats
+from scan_cache import DEFAULT_MAX_BYTES, ScanCache, content_key
 
-    json_output = {
-        "qRCodeData": qr_code_data,
-        "rightAnswers": right_answers,
-        "wrongAnswers": wrong_answers,
-        "multipleAnswers": multiple_answers,
-        "unAnswered": un_answered,
-        "Useranswers": user_answers,
-        "correctedImageUrl": final_image_path
+# Bump whenever a change alters what a scan reads from an image, so cached
+# results from older versions stop matching
+SCANNER_VERSION = '7.8'
+
+DESTINATION_SIZE = (2360, 3388)
+# Size of the corrected image; its marks are drawn at this size directly
+OUTPUT_SIZE = (1000, 1436)
+# Legend pasted into every corrected image, at each layout's guide_box
+CORRECTION_GUIDE_PATH = 'correction_guide.jpg'
+# Line width of the grading marks on the corrected image, in output pixels
+ANNOTATION_THICKNESS = 2
+# Marks are positioned in 1/2**ANNOTATION_SHIFT pixel fixed point, since
+# sheet coordinates do not land on whole output pixels
+ANNOTATION_SHIFT = 4
+DEFAULT_PAPER_SIZE = 'A4'
+CORRECTS_DIR = '../public/uploads/corrects'
+
+# Threads the AprilTag detector may use; batch workers lower this so that
+# N processes x M threads does not oversubscribe the machine
+APRILTAG_THREADS = 4
+
+# Tags are first looked for on the photo shrunk so its long side is about
+# COARSE_TARGET_SIDE (by an integer factor of 2 to 4) and only their
+# corners are refined at full resolution. Smaller photos skip straight to
+# the full-resolution pass.
+COARSE_TARGET_SIDE = 1200
+COARSE_MAX_DECIMATION = 4
+
+# Reductions libjpeg applies while decoding (by scaling the DCT), so an
+# encoded photo never has to be decoded larger than a stage needs
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+# 'hough' looks for the bubbles with HoughCircles; 'lattice' samples them
+# where the layout's 'bubbles' grid says they are printed. That grid was
+# fitted on ArUco sheets warped from the tags' outer corners, not in the
+# frame warp_sheet() builds from each AprilTag's top-left corner, so the
+# lattice stays opt-in until it is measured on a printed AprilTag sheet
+BUBBLE_ENGINE = 'hough'
+
+# Threads per stage and items waiting between stages of --batch --pipeline.
+# Every waiting item holds a warped sheet, so the queues stay short
+PIPELINE_THREADS = {'locate': 2, 'read': 1, 'finish': 2}
+PIPELINE_QUEUE_SIZE = 2
+
+# Where the preprocessing cascade keeps its per-deployment success counts
+# (None keeps them in memory only)
+DETECTION_STATS_PATH = 'detection_stats.json'
+
+# Deferred corrected images wait here, as what drawing them needs, until
+# render_pending() draws them. Each deferred scan has its own file, named
+# by a random render id, since the same QR code may be rescanned meanwhile.
+PENDING_RENDER_DIR = 'pending_renders'
+
+OPTIONS = ['A', 'B', 'C', 'D']
+# A bubble counts as filled when at least this share of its inner square is dark
+FILL_THRESHOLD = 0.4
+
+# One row per bubble of a sheet, x and y in warped-sheet coordinates
+BUBBLE_DTYPE = np.dtype([
+    ('question', np.int16),  # 1-based question number
+    ('option', np.int8),     # index into OPTIONS
+    ('x', np.int32),
+    ('y', np.int32),
+    ('r', np.int16),
+    ('fill', np.float32),    # fill score, 0.0-1.0
+    ('state', np.int8),      # BUBBLE_EMPTY, BUBBLE_MARKED or BUBBLE_MULTIPLE
+])
+BUBBLE_EMPTY, BUBBLE_MARKED, BUBBLE_MULTIPLE = 0, 1, 2
+
+# Everything that depends on the sheet layout, keyed by paper size.
+# Coordinates are in the warped DESTINATION_SIZE frame.
+PAPER_LAYOUTS = {
+    'A4': {
+        'tag_ids': [1, 2, 3, 4],
+        'questions': 120,
+        'questions_per_roi': 30,
+        'rois': {
+            'answer_sheet_roi_1': (200, 1180, 600, 3180),
+            'answer_sheet_roi_2': (740, 1180, 1140, 3180),
+            'answer_sheet_roi_3': (1313, 1180, 1713, 3180),
+            'answer_sheet_roi_4': (1860, 1180, 2260, 3180),
+        },
+        'min_radius': 33 // 2,
+        'fill_threshold': 120,
+        'circle_radius': 20,
+        'unanswered_radius': 10,
+        'square_size': 60,
+        'guide_box': ((1180, 641), (1570, 955)),
+        # Where the exam's QR code is printed, searched in this order. An
+        # estimate: the print page's position (admin/exam/print/page.tsx)
+        # mapped onto sheet120.png through its ArUco outer corners, not yet
+        # measured on a printed AprilTag sheet. Sheets whose code falls
+        # outside still go through whole_photo_qr_search()
+        'qr_boxes': ((40, 215, 590, 770),),
+        # Printed bubble grid for BUBBLE_ENGINE = 'lattice', fitted on ArUco
+        # sheets warped from their outer corners: x of option A in each ROI,
+        # the spacing between options and between questions, and the radius
+        'bubbles': {
+            'first_option_x': (246.5, 797.5, 1374.5, 1925.5),
+            'option_pitch': 93.0,
+            'first_row_y': 1230.7,
+            'row_pitch': 64.95,
+            'radius': 23,
+        },
+    },
+    'A5': {
+        'tag_ids': [5, 6, 7, 8],
+        'questions': 60,
+        'questions_per_roi': 20,
+        'rois': {
+            'answer_sheet_roi_1': (250, 1430, 750, 3190),
+            'answer_sheet_roi_2': (950, 1430, 1480, 3190),
+            'answer_sheet_roi_3': (1680, 1430, 2220, 3190),
+        },
+        'min_radius': 42 // 2,
+        'fill_threshold': 60,
+        'circle_radius': 25,
+        'unanswered_radius': 15,
+        'square_size': 80,
+        'guide_box': ((1570, 700), (2160, 1160)),
+        # Top left on sheets from the print page, in the info box on the right
+        # on the original A5 design. Estimates, like the A4 box: the print
+        # page's position mapped onto sheet1.png, and input.jpg's code, both
+        # through the ArUco outer corners
+        'qr_boxes': ((130, 220, 860, 950), (1465, 745, 1925, 1205)),
+        'bubbles': {
+            'first_option_x': (329.5, 1029.5, 1763.5),
+            'option_pitch': 118.4,
+            'first_row_y': 1494.2,
+            'row_pitch': 82.62,
+            'radius': 29,
+        },
+    },
+}
+
+
+def log(message):
+    # stdout is reserved for JSON results, diagnostics go to stderr
+    print(message, file=sys.stderr, flush=True)
+
+
+@dataclass
+class ScanResult:
+    """Everything produced while scanning one sheet; no state is kept at module level"""
+    qr_code_data: str = None
+    paper_size: str = None
+    answer_key: list = field(default_factory=list)
+    bubbles: np.ndarray = None         # BUBBLE_DTYPE table, one row per bubble
+    question_rows: np.ndarray = None   # (questions, 4) row of each bubble in bubbles, -1 when missing
+    corrected_image_path: str = None
+    corrected_image: bytes = None      # the corrected image as JPEG, once drawn
+    render_pending: bool = False       # corrected image deferred, not drawn yet
+    render_id: str = None              # what render_pending() takes to draw it
+
+    @property
+    def layout(self):
+        return PAPER_LAYOUTS[self.paper_size]
+
+    @property
+    def fill_matrix(self):
+        """(questions, 4) fill scores, 0 where the sheet has no bubble"""
+        fills = np.append(self.bubbles['fill'], np.float32(0))
+        return fills[self.question_rows]
+
+
+# ============================================================================
+# GRADING
+# ============================================================================
+
+def grade_fill_matrices(fill_matrices, answer_key):
+    """
+    Grade a stack of fill matrices against one answer key without touching any image.
+
+    Args:
+        fill_matrices: (sheets, questions, 4) fill scores, one matrix per sheet
+        answer_key: Correct option per question, 1-4 for A-D
+
+    Returns:
+        Dict of (sheets, len(answer_key)) arrays: 'user_answers' (1-4, or 0
+        for blank/multiple) and boolean masks 'right', 'wrong', 'multiple',
+        'unanswered'. Questions past the end of a matrix count as unanswered.
+    """
+    answer_key = np.asarray(answer_key, dtype=np.int8)
+    total_questions = len(answer_key)
+
+    filled = np.asarray(fill_matrices) >= FILL_THRESHOLD
+    sheets, questions = filled.shape[:2]
+    if questions < total_questions:
+        filled = np.concatenate([filled, np.zeros((sheets, total_questions - questions, len(OPTIONS)), bool)], axis=1)
+    filled = filled[:, :total_questions]
+
+    filled_count = filled.sum(axis=2)
+    single = filled_count == 1
+    user_answers = np.where(single, filled.argmax(axis=2) + 1, 0)
+
+    return {
+        'user_answers': user_answers,
+        'right': single & (user_answers == answer_key),
+        'wrong': single & (user_answers != answer_key),
+        'multiple': filled_count > 1,
+        'unanswered': filled_count == 0,
+    }
+
+
+def graded_json(grades, index):
+    """JSON-ready grading lists for one sheet of a grade_fill_matrices() result"""
+    def question_numbers(mask):
+        return (np.flatnonzero(mask[index]) + 1).tolist()
+
+    return {
+        "rightAnswers": question_numbers(grades['right']),
+        "wrongAnswers": question_numbers(grades['wrong']),
+        "multipleAnswers": question_numbers(grades['multiple']),
+        "unAnswered": question_numbers(grades['unanswered']),
+        "Useranswers": grades['user_answers'][index].tolist(),
     }
 
-    return json.dumps(json_output)
+
+def rounded_scores(scores):
+    # float64 first, float32 values would serialize as 0.800000011920929
+    return np.round(np.asarray(scores, dtype=np.float64), 2).tolist()
+
+
+def generate_json_output(result):
+    grades = grade_fill_matrices(result.fill_matrix[np.newaxis], result.answer_key)
+
+    json_output = {"qRCodeData": result.qr_code_data}
+    json_output.update(graded_json(grades, 0))
+    json_output.update({
+        "correctedImageUrl": result.corrected_image_path,
+        "paperSize": result.paper_size,
+        "fillMatrix": rounded_scores(result.fill_matrix),
+    })
+    if result.render_pending:
+        json_output["renderPending"] = True
+        json_output["renderId"] = result.render_id
+
+    return json_output
+
+
+def read_marked_answers(fill_matrix):
+    """
+    Marked option per question and how clearly it reads, for answer-key sheets.
+
+    Returns:
+        (answers, confidence): answers is 1-4, or 0 when a question is blank
+        or has several marks. confidence is 0.0-1.0: the gap between the two
+        darkest bubbles for a single mark, how empty the darkest bubble is for
+        a blank question, and 0 when several bubbles are marked.
+    """
+    filled = fill_matrix >= FILL_THRESHOLD
+    filled_count = filled.sum(axis=1)
+    ranked = np.sort(fill_matrix, axis=1)
+    darkest, runner_up = ranked[:, -1], ranked[:, -2]
+
+    answers = np.where(filled_count == 1, fill_matrix.argmax(axis=1) + 1, 0)
+    confidence = np.select(
+        [filled_count == 1, filled_count == 0],
+        [darkest - runner_up, 1.0 - darkest],
+        default=0.0,
+    )
+    return answers, np.clip(confidence, 0.0, 1.0)
+
+
+def checked_answer_key(answer_key):
+    """answer_key as a list, after checking every entry is an option number from 1 to len(OPTIONS)"""
+    answer_key = list(answer_key)
+    for question, answer in enumerate(answer_key, start=1):
+        if isinstance(answer, bool) or not isinstance(answer, (int, np.integer)) or not 1 <= answer <= len(OPTIONS):
+            raise ValueError(f"Invalid answer for question {question}: {answer!r} (expected 1-{len(OPTIONS)})")
+    return answer_key
+
+
+def regrade(records, answer_key):
+    """
+    Grade stored scan records against a new answer key.
+
+    records are dicts carrying "fillMatrix" either at the top level or under
+    "result" (so --serve/--batch output lines can be fed back unchanged).
+    Matrices with the same shape are graded together in one vectorized pass.
+    """
+    answer_key = checked_answer_key(answer_key)
+    responses = [None] * len(records)
+    by_shape = {}
+    for i, record in enumerate(records):
+        scan = record.get('result', record)
+        if 'fillMatrix' not in scan:
+            responses[i] = {"id": record.get('id'), "ok": False, "error": "Record has no fillMatrix"}
+            continue
+        matrix = np.asarray(scan['fillMatrix'], dtype=np.float32)
+        by_shape.setdefault(matrix.shape, []).append((i, matrix))
+
+    for entries in by_shape.values():
+        grades = grade_fill_matrices(np.stack([matrix for _, matrix in entries]), answer_key)
+        for row, (i, _) in enumerate(entries):
+            scan = records[i].get('result', records[i])
+            result = {"qRCodeData": scan.get('qRCodeData')}
+            result.update(graded_json(grades, row))
+            responses[i] = {"id": records[i].get('id'), "ok": True, "result": result}
+
+    return responses
 
 
 def detect_qr_code(image):
@@ -62,106 +333,208 @@ def detect_qr_code(image):
     return qr_data
 
 
-def read_local_image(file_path):
-    image = cv2.imread(file_path, cv2.IMREAD_COLOR)
+def search_qr_code(images):
+    """detect_qr_code() of the first of images that has a readable code, None when none has"""
+    for image in images:
+        qr_code_data = detect_qr_code(image)
+        if qr_code_data is not None:
+            return qr_code_data
+    return None
+
+
+def start_qr_search(images):
+    """search_qr_code(images) on a helper thread, returns a function that waits for its payload"""
+    found = {}
+    thread = threading.Thread(target=lambda: found.setdefault('data', search_qr_code(images)), daemon=True)
+    thread.start()
+
+    def wait():
+        thread.join()
+        return found.get('data')
+    return wait
+
+
+def whole_photo_qr_search(*images, concurrent=True):
+    """
+    Function returning search_qr_code(images), for when the qr_boxes had no code.
+
+    With concurrent and a spare core the search starts right away on a
+    helper thread, so the caller can warp the sheet meanwhile. Batch runs
+    pass concurrent=False since every core already has a sheet of its own.
+    """
+    if concurrent and available_cores() > 1:
+        return start_qr_search(images)
+    return lambda: search_qr_code(images)
+
+
+def read_local_image(file_path, flags=cv2.IMREAD_GRAYSCALE):
+    """Decode an image from disk, grayscale by default since nothing before the annotated output needs color"""
+    image = cv2.imread(file_path, flags)
     if image is not None:
         return image
     else:
         raise Exception(f"Error reading image from path: {file_path}")
 
 
-def detect_paper_size_and_set_rois(ids):
-    global rois
+def read_image_bytes(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read()
+    except OSError:
+        raise Exception(f"Error reading image from path: {file_path}")
+
+
+def decode_image(image_bytes, reduction=1, image_path=None):
+    """Grayscale decode of an encoded image, shrunk by a factor from REDUCED_DECODE_FLAGS"""
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), REDUCED_DECODE_FLAGS[reduction])
+    if image is None:
+        raise Exception(f"Error reading image from path: {image_path}" if image_path else "Error decoding image")
+    return image
+
+
+def image_size(image_bytes):
+    """(width, height) from a JPEG or PNG header without decoding, None for other formats"""
+    if image_bytes[:8] == b'\x89PNG\r\n\x1a\n' and len(image_bytes) >= 24:
+        return struct.unpack('>II', image_bytes[16:24])
+    if image_bytes[:2] != b'\xff\xd8':
+        return None
+    # Walk the marker segments up to the start-of-frame that holds the size
+    offset = 2
+    while offset + 9 <= len(image_bytes):
+        if image_bytes[offset] != 0xFF:
+            return None
+        marker = image_bytes[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', image_bytes[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + struct.unpack('>H', image_bytes[offset + 2:offset + 4])[0]
+    return None
+
+
+def detect_paper_size(ids):
     if ids is not None:
         ids_set = set(ids)
-        paper_sizes = {
-            'A4': {
-                'ids': {1, 2, 3, 4},
-                'rois': {
-                    'answer_sheet_roi_1': (200, 1180, 600, 3180),
-                    'answer_sheet_roi_2': (740, 1180, 1140, 3180),
-                    'answer_sheet_roi_3': (1313, 1180, 1713, 3180),
-                    'answer_sheet_roi_4': (1860, 1180, 2260, 3180),
-                }
-            },
-            'A5': {
-                'ids': {5, 6, 7, 8},
-                'rois': {
-                    'answer_sheet_roi_1': (250, 1430, 750, 3190),
-                    'answer_sheet_roi_2': (950, 1430, 1480, 3190),
-                    'answer_sheet_roi_3': (1680, 1430, 2220, 3190),
-                }
-            }
-        }
-
-        for size, details in paper_sizes.items():
-            if details['ids'].issubset(ids_set):
-                rois = details['rois']
+        for size, layout in PAPER_LAYOUTS.items():
+            if set(layout['tag_ids']).issubset(ids_set):
                 return size
     return None
 
 
+def as_gray(image):
+    """The image itself when it is already single-channel, else its grayscale conversion"""
+    return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
 def convert_to_two_tone(image):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if isinstance(image, dict):
+        # Answer ROIs from warp_located_sheet(answers_only=True)
+        return {key: convert_to_two_tone(region) for key, region in image.items()}
+    gray = as_gray(image)
     _, thresholded = cv2.threshold(gray, 140, 255, cv2.THRESH_BINARY)
     return thresholded
 
 
-def enhance_image_for_detection(gray_image):
-    """Apply preprocessing to improve tag detection"""
-    enhanced_images = []
-    
-    # Original
-    enhanced_images.append(gray_image)
-    
-    # Histogram equalization
-    equalized = cv2.equalizeHist(gray_image)
-    enhanced_images.append(equalized)
-    
+PREPROCESSING_VARIANTS = {
+    'original': lambda gray_image: gray_image,
+    'equalized': cv2.equalizeHist,
     # CLAHE (Contrast Limited Adaptive Histogram Equalization)
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-    clahe_img = clahe.apply(gray_image)
-    enhanced_images.append(clahe_img)
-    
+    'clahe': lambda gray_image: cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8)).apply(gray_image),
     # Bilateral filter (reduces noise while keeping edges)
-    bilateral = cv2.bilateralFilter(gray_image, 9, 75, 75)
-    enhanced_images.append(bilateral)
-    
-    return enhanced_images
+    'bilateral': lambda gray_image: cv2.bilateralFilter(gray_image, 9, 75, 75),
+}
 
+_cascade_stats = None
 
-def warp_image_apriltag(input_image):
-    """Warp image using AprilTag markers with support for 3+ markers"""
-    global paper_size
-    
-    gray = cv2.cvtColor(input_image, cv2.COLOR_BGR2GRAY)
-    
-    # Initialize AprilTag detector with optimal settings
-    detector = apriltag.Detector(
+
+def cascade_stats():
+    global _cascade_stats
+    if _cascade_stats is None:
+        _cascade_stats = CascadeStats(DETECTION_STATS_PATH, PREPROCESSING_VARIANTS)
+    return _cascade_stats
+
+
+def flush_cascade_stats():
+    if _cascade_stats is not None:
+        _cascade_stats.flush()
+
+
+def enhance_image_for_detection(gray_image, order=None, pass_name='full'):
+    """
+    Yield (name, image) preprocessing variants to improve tag detection.
+
+    Each variant is only computed when the caller asks for the next one, so a
+    sheet that is detected on the first try never pays for the rest. The
+    order defaults to the variants' success rates for pass_name in this
+    deployment.
+    """
+    for name in order or cascade_stats().order(pass_name):
+        yield name, PREPROCESSING_VARIANTS[name](gray_image)
+
+
+_detectors = threading.local()
+
+
+def get_apriltag_detector(**options):
+    """
+    Shared AprilTag detector for one set of options, built on first use.
+
+    Building a detector allocates the tag family tables and a worker pool,
+    which a warm worker should only pay once. A detector must not run two
+    detect() calls at the same time, so each thread keeps its own.
+    """
+    detectors = getattr(_detectors, 'apriltag', None)
+    if detectors is None:
+        detectors = _detectors.apriltag = {}
+
+    key = tuple(sorted(options.items()))
+    detector = detectors.get(key)
+    if detector is None:
+        detector = detectors[key] = apriltag.Detector(**options)
+    return detector
+
+
+def apriltag_detector(quad_decimate=1.0):
+    """AprilTag detector with our standard settings, quad_decimate=1.0 gives the best accuracy"""
+    return get_apriltag_detector(
         families='tag36h11',
-        nthreads=4,
-        quad_decimate=1.0,      # No decimation for best accuracy
+        nthreads=APRILTAG_THREADS,
+        quad_decimate=quad_decimate,
         quad_sigma=0.0,         # Detect blurred tags
         refine_edges=True,      # Subpixel edge refinement
         decode_sharpening=0.25, # Sharpening for better decoding
         debug=False
     )
-    
-    # Try multiple preprocessing techniques
-    enhanced_images = enhance_image_for_detection(gray)
-    
+
+
+def detect_apriltags(gray, detector, enhance=True, pass_name='full'):
+    """
+    Detect AprilTags, retrying on enhanced variants of the image until 3+ are found.
+
+    pass_name ('coarse' for a decimated or reduced image, 'full' otherwise)
+    keeps the preprocessing success counts of the two apart.
+
+    Returns:
+        Dictionary mapping tag id to its corners as [top-left, top-right, bottom-right, bottom-left]
+    """
+    candidates = enhance_image_for_detection(gray, pass_name=pass_name) if enhance else [('original', gray)]
+
     results = None
-    for enhanced_img in enhanced_images:
+    outcomes = []
+    for name, enhanced_img in candidates:
         results = detector.detect(enhanced_img)
+        outcomes.append((name, len(results) >= 3))
         if len(results) >= 3:
             break
-    
-    if results is None or len(results) < 3:
-        raise ValueError(f"Not enough AprilTags detected. Found: {len(results) if results else 0}")
-    
+
+    if enhance:
+        cascade_stats().record(pass_name, outcomes)
+
     # Extract IDs and corners from AprilTag results
     detected_tags = {}
-    for r in results:
+    for r in results or []:
         tag_id = r.tag_id
         # AprilTag corners order: [bottom-left, bottom-right, top-right, top-left]
         # We need them in OpenCV format: [top-left, top-right, bottom-right, bottom-left]
@@ -172,15 +545,84 @@ def warp_image_apriltag(input_image):
             r.corners[0]   # bottom-left
         ], dtype="float32")
         detected_tags[tag_id] = corners_reordered
+
+    return detected_tags
+
+
+def coarse_decimation(shape):
+    """Integer factor the coarse pass shrinks an image of this shape by, 1 when it should be skipped"""
+    return min(COARSE_MAX_DECIMATION, max(shape[:2]) // COARSE_TARGET_SIDE)
+
+
+def detection_reduction(size):
+    """Decode reduction for reading tags and the QR code, the coarse pass's factor rounded down to what libjpeg offers"""
+    factor = coarse_decimation(size[::-1])
+    return max(f for f in REDUCED_DECODE_FLAGS if f <= factor)
+
+
+def warp_reduction(size):
+    """Largest decode reduction that still leaves at least DESTINATION_SIZE pixels to warp from, in either orientation (1 when none does)"""
+    short_side, long_side = sorted(size)
+    return max((f for f in REDUCED_DECODE_FLAGS
+                if short_side / f >= min(DESTINATION_SIZE) and long_side / f >= max(DESTINATION_SIZE)), default=1)
+
+
+def refine_tag_corners(gray, detected_tags, factor):
+    """
+    Map corners found on an image shrunk by factor back to gray and refine them
+    with cornerSubPix in a small window around each coarse hit.
+    """
+    if not detected_tags:
+        return detected_tags
+    ids = list(detected_tags)
+    # The detector puts the origin at the top-left edge of the first pixel,
+    # cornerSubPix at its centre
+    corners = np.concatenate([detected_tags[i] for i in ids]) * factor - 0.5
+    corners = corners.reshape(-1, 1, 2).astype(np.float32)
+    half_window = 2 * factor + 1
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    cv2.cornerSubPix(gray, corners, (half_window, half_window), (-1, -1), criteria)
+    corners = corners.reshape(len(ids), 4, 2) + 0.5
+    return {tag_id: corners[index] for index, tag_id in enumerate(ids)}
+
+
+def locate_tags(gray, coarse=True):
+    """
+    Find the AprilTags of a full-resolution grayscale photo.
+
+    With coarse=True tags are detected on a decimated copy first and only
+    their corners are refined at full resolution; the full-resolution
+    detection only runs when that finds fewer than 3 tags.
+    """
+    detector = apriltag_detector()
+    factor = coarse_decimation(gray.shape) if coarse else 1
+    if factor > 1:
+        small = cv2.resize(gray, (gray.shape[1] // factor, gray.shape[0] // factor), interpolation=cv2.INTER_AREA)
+        detected_tags = detect_apriltags(small, detector, pass_name='coarse')
+        if len(detected_tags) >= 3:
+            log(f"[INFO] Found tags at 1/{factor} resolution, refining corners")
+            return refine_tag_corners(gray, detected_tags, factor)
+        log(f"[INFO] Coarse pass found {len(detected_tags)} tags, retrying at full resolution")
+    return detect_apriltags(gray, detector)
+
+
+def sheet_transform(detected_tags):
+    """
+    Transform from the photo to the DESTINATION_SIZE frame, from 3+ AprilTag markers
+
+    Returns (2x3 affine or 3x3 perspective matrix, paper_size)
+    """
+    if len(detected_tags) < 3:
+        raise ValueError(f"Not enough AprilTags detected. Found: {len(detected_tags)}")
     
     ids = np.array(list(detected_tags.keys()))
     
     # Detect paper size based on tag IDs
-    paper_size = detect_paper_size_and_set_rois(ids)
+    paper_size = detect_paper_size(ids)
     
-    if paper_size in ['A4', 'A5']:
-        destination_size = (2360, 3388)
-        target_ids = [1, 2, 3, 4] if paper_size == 'A4' else [5, 6, 7, 8]
+    if paper_size in PAPER_LAYOUTS:
+        destination_size = DESTINATION_SIZE
+        target_ids = PAPER_LAYOUTS[paper_size]['tag_ids']
         
         # Find which markers are detected
         available_markers = [i for i in target_ids if i in detected_tags]
@@ -188,7 +630,7 @@ def warp_image_apriltag(input_image):
         if len(available_markers) < 3:
             raise ValueError(f"Not enough target markers detected. Found: {available_markers}")
         
-        print(f"[INFO] Detected {len(available_markers)} AprilTags: {available_markers}")
+        log(f"[INFO] Detected {len(available_markers)} AprilTags: {available_markers}")
         
         # Define marker positions for all 4 corners (same as before)
         marker_positions = {
@@ -212,36 +654,88 @@ def warp_image_apriltag(input_image):
         destination_points = np.array(destination_points, dtype="float32")
         
         if len(available_markers) == 3:
-            print("[INFO] Using affine transformation (3 markers)")
+            log("[INFO] Using affine transformation (3 markers)")
             transform_matrix = cv2.getAffineTransform(source_points[:3], destination_points[:3])
-            warped_image = cv2.warpAffine(input_image, transform_matrix, destination_size)
         else:
-            print("[INFO] Using perspective transformation (4 markers)")
+            log("[INFO] Using perspective transformation (4 markers)")
             transform_matrix = cv2.getPerspectiveTransform(source_points, destination_points)
-            warped_image = cv2.warpPerspective(input_image, transform_matrix, destination_size)
         
-        return warped_image
+        return transform_matrix, paper_size
     else:
         raise ValueError("Unknown paper size or AprilTags not found")
 
 
+def warp_sheet(input_image, transform_matrix, size=DESTINATION_SIZE, origin=(0, 0)):
+    """Warp the size window of the sheet frame whose top-left corner is at origin"""
+    shift = np.array([[1, 0, -origin[0]], [0, 1, -origin[1]], [0, 0, 1]], dtype=np.float64)
+    if transform_matrix.shape[0] == 2:
+        return cv2.warpAffine(input_image, (shift @ np.vstack([transform_matrix, [0, 0, 1]]))[:2], size)
+    return cv2.warpPerspective(input_image, shift @ transform_matrix, size)
+
+
+def warp_image_apriltag(input_image, detected_tags=None):
+    """
+    Warp image using AprilTag markers with support for 3+ markers, returns (warped, paper_size)
+
+    detected_tags are looked up with locate_tags() unless the caller already
+    found them in input_image's coordinates.
+    """
+    if detected_tags is None:
+        detected_tags = locate_tags(as_gray(input_image))
+    transform_matrix, paper_size = sheet_transform(detected_tags)
+    return warp_sheet(input_image, transform_matrix), paper_size
+
+
+def warp_answer_regions(input_image, transform_matrix, rois):
+    """Warp only the answer ROIs of the sheet, as {roi name: image of that rectangle}"""
+    return {
+        key: warp_sheet(input_image, transform_matrix, (x2 - x1, y2 - y1), (x1, y1))
+        for key, (x1, y1, x2, y2) in rois.items()
+    }
+
+
+def tag_transform(detected_tags):
+    """sheet_transform(), or None when the tags cannot place the sheet"""
+    try:
+        return sheet_transform(detected_tags)
+    except ValueError:
+        return None
+
+
+def read_sheet_qr(input_image, transform, layout=None):
+    """
+    Decode the QR code from the layout's qr_boxes, warped straight out of input_image.
+
+    transform is sheet_transform()'s (matrix, paper_size). A box is a few
+    hundred pixels a side, so this is far cheaper than searching the whole
+    photo, and a code lying next to the sheet cannot be picked up instead.
+    Returns None when no box holds a readable code.
+    """
+    transform_matrix, paper_size = transform
+    for x1, y1, x2, y2 in PAPER_LAYOUTS[layout or paper_size]['qr_boxes']:
+        qr_code_data = detect_qr_code(warp_sheet(input_image, transform_matrix, (x2 - x1, y2 - y1), (x1, y1)))
+        if qr_code_data is not None:
+            return qr_code_data
+    return None
+
+
 def warp_image_feature_matching(input_image, template_path):
-    """Warp image using feature matching with RANSAC (fallback method)"""
-    global paper_size
+    """Warp image using feature matching with RANSAC (fallback method), returns (warped, paper_size)"""
+    paper_size = None
     
-    print("[INFO] AprilTag detection failed. Attempting feature matching with RANSAC...")
+    log("[INFO] AprilTag detection failed. Attempting feature matching with RANSAC...")
     
     # Try to load template
     try:
-        template = cv2.imread(template_path)
+        template = cv2.imread(template_path, cv2.IMREAD_GRAYSCALE)
         if template is None:
             raise ValueError(f"Template image not found at: {template_path}")
     except Exception as e:
         raise ValueError(f"Cannot load template image: {e}")
     
     # Convert to grayscale
-    gray_input = cv2.cvtColor(input_image, cv2.COLOR_BGR2GRAY)
-    gray_template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+    gray_input = as_gray(input_image)
+    gray_template = template
     
     # Detect ORB features
     orb = cv2.ORB_create(5000)
@@ -263,7 +757,7 @@ def warp_image_feature_matching(input_image, template_path):
             if m.distance < 0.75 * n.distance:
                 good_matches.append(m)
     
-    print(f"[INFO] Found {len(good_matches)} good feature matches")
+    log(f"[INFO] Found {len(good_matches)} good feature matches")
     
     if len(good_matches) < 10:
         raise ValueError(f"Not enough feature matches found: {len(good_matches)}")
@@ -280,7 +774,7 @@ def warp_image_feature_matching(input_image, template_path):
     
     matches_mask = mask.ravel().tolist()
     inliers = sum(matches_mask)
-    print(f"[INFO] RANSAC inliers: {inliers}/{len(good_matches)} ({100*inliers/len(good_matches):.1f}%)")
+    log(f"[INFO] RANSAC inliers: {inliers}/{len(good_matches)} ({100*inliers/len(good_matches):.1f}%)")
     
     if inliers < 10:
         raise ValueError(f"Not enough inliers for reliable transformation: {inliers}")
@@ -291,27 +785,27 @@ def warp_image_feature_matching(input_image, template_path):
     
     # Detect paper size from warped image
     try:
-        gray_warped = cv2.cvtColor(warped, cv2.COLOR_BGR2GRAY)
-        detector = apriltag.Detector(families='tag36h11')
+        gray_warped = as_gray(warped)
+        detector = get_apriltag_detector(families='tag36h11')
         results = detector.detect(gray_warped)
         if results:
             ids = np.array([r.tag_id for r in results])
-            paper_size = detect_paper_size_and_set_rois(ids)
+            paper_size = detect_paper_size(ids)
     except:
-        paper_size = 'A4'  # Default to A4
+        paper_size = DEFAULT_PAPER_SIZE
     
-    print(f"[INFO] Feature matching successful. Paper size: {paper_size}")
+    log(f"[INFO] Feature matching successful. Paper size: {paper_size}")
     
-    return warped
+    return warped, paper_size
 
 
-def warp_image(input_image, template_path='blank_template.jpg'):
+def warp_image(input_image, template_path='blank_template.jpg', detected_tags=None):
     """Main warping function with AprilTag + RANSAC fallback"""
     try:
         # Try AprilTag detection first
-        return warp_image_apriltag(input_image)
+        return warp_image_apriltag(input_image, detected_tags)
     except ValueError as e:
-        print(f"[WARNING] AprilTag detection failed: {e}")
+        log(f"[WARNING] AprilTag detection failed: {e}")
         try:
             # Fall back to feature matching
             return warp_image_feature_matching(input_image, template_path)
@@ -328,13 +822,14 @@ def detect_circles(input_image, min_radius=0):
     return circles
 
 
-def sort_circles_spatially(circles, roi_index, y_tolerance=15):
+def sort_circles_spatially(circles, roi_index, paper_size, y_tolerance=15):
     """
     Sort circles by spatial position (Y then X) and assign question/option based on position
     
     Args:
         circles: Array of detected circles
         roi_index: Index of the ROI (1-4 for A4, 1-3 for A5)
+        paper_size: 'A4' or 'A5', selects how many questions each ROI holds
         y_tolerance: Maximum Y-difference to consider circles in same row
     
     Returns:
@@ -363,12 +858,7 @@ def sort_circles_spatially(circles, roi_index, y_tolerance=15):
         rows[i] = sorted(rows[i], key=lambda c: c[0])
     
     # Calculate base question number for this ROI
-    if paper_size == 'A4':
-        base_question = (roi_index - 1) * 30
-    elif paper_size == 'A5':
-        base_question = (roi_index - 1) * 20
-    else:
-        base_question = (roi_index - 1) * 30
+    base_question = (roi_index - 1) * PAPER_LAYOUTS[paper_size]['questions_per_roi']
     
     # Assign question numbers and options
     circle_mapping = {}
@@ -391,184 +881,1219 @@ def process_roi(image, roi, min_radius):
     return cropped_image, circles
 
 
-def is_filled_circle(image, circle):
-    global paper_size
-    threshold = 120 if paper_size == 'A4' else 60 if paper_size == 'A5' else 120
-    x, y, r = circle
-    points_to_check = [
-        (x, y),
-        (x - r//2, y), (x + r//2, y),
-        (x, y - r//2), (x, y + r//2)
+def fill_scores(image, xs, ys, radii, paper_size):
+    """
+    Mean darkness of the square inside each bubble, 0.0-1.0, gathered in one NumPy pass per radius.
+
+    xs, ys and radii hold one entry per bubble in sheet coordinates. The square
+    spans half a radius either side of the centre, so the printed outline is
+    never counted.
+    """
+    threshold = PAPER_LAYOUTS[paper_size]['fill_threshold']
+    height, width = image.shape[:2]
+    xs, ys, radii = np.asarray(xs, np.int64), np.asarray(ys, np.int64), np.asarray(radii, np.int64)
+
+    scores = np.zeros(len(xs), dtype=np.float32)
+    # The lattice has one radius per layout, Hough circles only a handful
+    for radius in np.unique(radii):
+        selected = radii == radius
+        half = int(radius) // 2
+        side = 2 * half + 1
+        windows = sliding_window_view(image, (side, side))
+        tops = np.clip(ys[selected] - half, 0, height - side)
+        lefts = np.clip(xs[selected] - half, 0, width - side)
+        scores[selected] = np.count_nonzero(windows[tops, lefts] < threshold, axis=(1, 2)) / (side * side)
+    return scores
+
+
+# ============================================================================
+# SCAN PIPELINE
+# ============================================================================
+
+_lattices = {}
+
+
+def bubble_table(rows):
+    """BUBBLE_DTYPE table from (question, option index, x, y, r) rows"""
+    bubbles = np.zeros(len(rows), dtype=BUBBLE_DTYPE)
+    if rows:
+        questions, options, xs, ys, radii = zip(*rows)
+        bubbles['question'], bubbles['option'] = questions, options
+        bubbles['x'], bubbles['y'], bubbles['r'] = xs, ys, radii
+    return bubbles
+
+
+def bubble_lattice(paper_size):
+    """Every printed bubble of a layout as a read-only BUBBLE_DTYPE table, built once per paper size"""
+    if paper_size not in _lattices:
+        layout = PAPER_LAYOUTS[paper_size]
+        grid = layout['bubbles']
+        rows = []
+        for roi_index, first_x in enumerate(grid['first_option_x']):
+            base_question = roi_index * layout['questions_per_roi']
+            for row in range(layout['questions_per_roi']):
+                y = round(grid['first_row_y'] + row * grid['row_pitch'])
+                for column in range(len(OPTIONS)):
+                    x = round(first_x + column * grid['option_pitch'])
+                    rows.append((base_question + row + 1, column, x, y, grid['radius']))
+        lattice = bubble_table(rows)
+        lattice.setflags(write=False)
+        _lattices[paper_size] = lattice
+    return _lattices[paper_size]
+
+
+def hough_bubbles(final_image, result):
+    """Find the bubbles with HoughCircles and number them by position, for sheets off the printed layout"""
+    layout = result.layout
+    rois = layout['rois']
+
+    # Detect circles in each ROI
+    detected_circles = {}
+    for key, roi in rois.items():
+        if isinstance(final_image, dict):
+            circles = detect_circles(final_image[key], min_radius=layout['min_radius'])
+        else:
+            _, circles = process_roi(final_image, roi, min_radius=layout['min_radius'])
+        if circles is not None:
+            detected_circles[key] = circles
+
+    # Process circles using spatial positioning
+    rows = []
+    for roi_key, circles in detected_circles.items():
+        roi_index = int(roi_key.split('_')[-1])
+        x_offset, y_offset = rois[roi_key][0], rois[roi_key][1]
+        for question_number, option, (x, y, r) in sort_circles_spatially(circles, roi_index, result.paper_size).values():
+            # Rows past the last question of the sheet are noise, not answers
+            if question_number <= layout['questions']:
+                rows.append((question_number, OPTIONS.index(option), int(x) + x_offset, int(y) + y_offset, int(r)))
+    return bubble_table(rows)
+
+
+def index_questions(bubbles, question_count):
+    """(questions, 4) row of each question's bubbles in the table, -1 where a bubble is missing"""
+    question_rows = np.full((question_count, len(OPTIONS)), -1, dtype=np.int32)
+    question_rows[bubbles['question'] - 1, bubbles['option']] = np.arange(len(bubbles), dtype=np.int32)
+    return question_rows
+
+
+def read_answers(final_image, result):
+    """Score every bubble of the two-tone sheet, or of its answer ROIs, and record which ones are filled"""
+    if BUBBLE_ENGINE == 'hough':
+        bubbles = hough_bubbles(final_image, result)
+    else:
+        bubbles = bubble_lattice(result.paper_size).copy()
+
+    if isinstance(final_image, dict):
+        # One pass per ROI, in the ROI's own coordinates
+        for key, (x1, y1, x2, y2) in result.layout['rois'].items():
+            xs, ys = bubbles['x'], bubbles['y']
+            inside = (xs >= x1) & (xs < x2) & (ys >= y1) & (ys < y2)
+            bubbles['fill'][inside] = fill_scores(
+                final_image[key], xs[inside] - x1, ys[inside] - y1, bubbles['r'][inside], result.paper_size)
+    else:
+        # Score every bubble in one pass
+        bubbles['fill'] = fill_scores(final_image, bubbles['x'], bubbles['y'], bubbles['r'], result.paper_size)
+
+    result.bubbles = bubbles
+    result.question_rows = index_questions(bubbles, result.layout['questions'])
+    mark_bubbles(bubbles)
+
+
+def mark_bubbles(bubbles):
+    """Set the state column: empty, the only mark of its question, or one of several marks"""
+    filled = bubbles['fill'] >= FILL_THRESHOLD
+    marks = np.bincount(bubbles['question'][filled], minlength=bubbles['question'].max(initial=0) + 1)
+    bubbles['state'] = np.where(
+        ~filled, BUBBLE_EMPTY, np.where(marks[bubbles['question']] > 1, BUBBLE_MULTIPLE, BUBBLE_MARKED))
+
+
+_correction_guides = {}
+
+
+def correction_guide(box_size):
+    """
+    The correction guide resized to box_size (width, height), kept between scans.
+
+    Entries are dropped when the file on disk changes, so a new guide is
+    picked up without restarting a worker.
+    """
+    stat = os.stat(CORRECTION_GUIDE_PATH)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _correction_guides.get(box_size)
+    if cached is None or cached[0] != version:
+        guide = cv2.imread(CORRECTION_GUIDE_PATH)
+        if guide is None:
+            raise Exception(f"Error reading image from path: {CORRECTION_GUIDE_PATH}")
+        guide = cv2.resize(guide, box_size)
+        guide.setflags(write=False)
+        cached = _correction_guides[box_size] = (version, guide)
+    return cached[1]
+
+
+def shrink_sheet(final_image):
+    """The two-tone sheet at OUTPUT_SIZE, all annotate_sheet() needs of it"""
+    if final_image.shape[1::-1] == OUTPUT_SIZE:
+        return final_image
+    return cv2.resize(final_image, OUTPUT_SIZE)
+
+
+def annotate_sheet(final_image, result):
+    """
+    Draw the grading marks and correction guide on a color copy of the two-tone sheet.
+
+    The sheet is shrunk to OUTPUT_SIZE first (unless shrink_sheet() already
+    did) and the marks, whose sizes the layout gives in sheet pixels, are
+    scaled and drawn straight at that size.
+    """
+    layout = result.layout
+    bubbles = result.bubbles
+
+    scale_x = OUTPUT_SIZE[0] / DESTINATION_SIZE[0]
+    scale_y = OUTPUT_SIZE[1] / DESTINATION_SIZE[1]
+    one = 1 << ANNOTATION_SHIFT
+
+    def point(x, y):
+        # Pixel centres of the sheet map onto pixel centres of the output
+        return round(((x + 0.5) * scale_x - 0.5) * one), round(((y + 0.5) * scale_y - 0.5) * one)
+
+    def length(size):
+        return round(size * scale_x * one)
+
+    def draw_circle(x, y, radius, color, thickness):
+        cv2.circle(final_image_color, point(x, y), length(radius), color, thickness, cv2.LINE_AA, ANNOTATION_SHIFT)
+
+    # Visualization and correction
+    circle_radius = layout['circle_radius']
+    final_image_color = cv2.cvtColor(shrink_sheet(final_image), cv2.COLOR_GRAY2BGR)
+    half_square = layout['square_size'] // 2
+
+    # Correct option of every bubble's question, -1 past the end of the key
+    answer_key = np.append(np.asarray(result.answer_key, dtype=np.int16) - 1, -1)
+    questions = np.minimum(bubbles['question'], len(answer_key)) - 1
+    correct = bubbles['option'] == answer_key[questions]
+    in_key = bubbles['question'] <= len(result.answer_key)
+    marked = bubbles['state'] != BUBBLE_EMPTY
+    answered = np.bincount(bubbles['question'][marked], minlength=bubbles['question'].max(initial=0) + 1) > 0
+
+    # Draw correct answer circles (green)
+    for x, y in bubbles[correct][['x', 'y']].tolist():
+        draw_circle(x, y, circle_radius, (0, 255, 0), ANNOTATION_THICKNESS)
+
+    # Draw yellow circles for unanswered questions
+    circle_radius_yellow = layout['unanswered_radius']
+    for x, y in bubbles[correct & ~answered[bubbles['question']]][['x', 'y']].tolist():
+        draw_circle(x, y, circle_radius_yellow, (0, 255, 255), -1)
+
+    # Draw rectangles for filled answers: yellow for multiple answers, green
+    # for a correct single answer, red for a wrong one. Neighbouring squares
+    # touch, so they are drawn in table order whatever their color
+    colors = np.select(
+        [bubbles['state'] == BUBBLE_MULTIPLE, correct],
+        [0, 1],
+        default=2,
+    )
+    rectangle_colors = [(0, 255, 255), (55, 155, 55), (35, 35, 200)]
+    selected = in_key & (bubbles['state'] != BUBBLE_EMPTY)
+    for x, y, color in zip(bubbles['x'][selected].tolist(), bubbles['y'][selected].tolist(), colors[selected].tolist()):
+        cv2.rectangle(final_image_color, point(x - half_square, y - half_square), point(x + half_square, y + half_square),
+                      rectangle_colors[color], ANNOTATION_THICKNESS, cv2.LINE_AA, ANNOTATION_SHIFT)
+
+    # Add correction guide, fitted to its box at the output size
+    (left, top), (right, bottom) = [(round(x * scale_x), round(y * scale_y)) for x, y in layout['guide_box']]
+    final_image_color[top:bottom, left:right] = correction_guide((right - left, bottom - top))
+
+    return final_image_color
+
+
+def locate_sheet(image, layout=None, answers_only=False, concurrent_qr_search=True):
+    """
+    Read the QR code and warp the sheet into the DESTINATION_SIZE frame.
+
+    find_sheet() followed by warp_found_sheet(). image is a decoded array,
+    the encoded file's bytes or its path. With answers_only, only the answer
+    ROIs are warped (see warp_located_sheet()).
+
+    Returns:
+        (ScanResult with qr_code_data and paper_size set, warped image or ROIs)
+    """
+    result, placement = find_sheet(image, layout, concurrent_qr_search=concurrent_qr_search)
+    return result, warp_found_sheet(result, placement, layout, answers_only)
+
+
+def locate_encoded_sheet(image_bytes, layout=None, image_path=None, answers_only=False, concurrent_qr_search=True):
+    """locate_sheet() for an encoded photo that may also be decoded from image_path, see locate_encoded_tags()"""
+    result, placement = find_sheet(image_bytes, layout, image_path, concurrent_qr_search)
+    return result, warp_found_sheet(result, placement, layout, answers_only)
+
+
+@dataclass
+class SheetPlacement:
+    """What find_sheet() learned about a photo, for warp_found_sheet() to finish with"""
+    source: np.ndarray           # image the warp samples from
+    detected_tags: dict
+    transform: tuple = None      # sheet_transform() of the tags, None when they cannot place the sheet
+    search_qr: object = None     # whole-photo QR search still to be waited for
+
+
+def find_sheet(image, layout=None, image_path=None, concurrent_qr_search=True, wait_for_qr=False):
+    """
+    First half of locate_sheet(): locate the tags and read the QR code, without warping.
+
+    The QR code is looked for in the layout's qr_boxes (see read_sheet_qr())
+    and the whole photo is only searched when they have none. That search
+    runs alongside the warp in warp_found_sheet() (see
+    whole_photo_qr_search()), unless wait_for_qr asks for the payload now.
+    Encoded photos go through locate_encoded_tags().
+
+    Returns:
+        (ScanResult, SheetPlacement). The result's paper_size is already set
+        when the tags place the sheet, and qr_code_data unless the search
+        is still running.
+    """
+    if isinstance(image, str):
+        image_path, image = image, read_image_bytes(image)
+    if layout is not None and layout not in PAPER_LAYOUTS:
+        raise ValueError(f"Unknown layout: {layout}")
+
+    if isinstance(image, bytes):
+        small, source, detected_tags = locate_encoded_tags(image, image_path)
+    else:
+        small = source = image
+        detected_tags = locate_tags(as_gray(image))
+    placement = SheetPlacement(source, detected_tags, tag_transform(detected_tags))
+
+    result = ScanResult()
+    if placement.transform is not None:
+        result.paper_size = layout or placement.transform[1]
+        result.qr_code_data = read_sheet_qr(source, placement.transform, layout)
+    if result.qr_code_data is None:
+        images = [small] if source is small else [small, source]
+        if wait_for_qr:
+            result.qr_code_data = search_qr_code(images)
+        else:
+            placement.search_qr = whole_photo_qr_search(*images, concurrent=concurrent_qr_search)
+
+    return result, placement
+
+
+def warp_found_sheet(result, placement, layout=None, answers_only=False):
+    """Second half of locate_sheet(): warp what find_sheet() found, finishing result's QR code and paper size"""
+    warped_image, paper_size = warp_located_sheet(
+        placement.source, placement.detected_tags, layout, answers_only, placement.transform)
+    if placement.search_qr is not None:
+        result.qr_code_data = placement.search_qr()
+        placement.search_qr = None
+    result.paper_size = layout or paper_size or DEFAULT_PAPER_SIZE
+    return warped_image
+
+
+def warp_located_sheet(source, detected_tags, layout=None, answers_only=False, transform=None):
+    """
+    Warp a photo whose tags were located, returns (warped, paper_size).
+
+    With answers_only, warped is {roi name: image} holding just the layout's
+    answer ROIs, which is all bubble reading looks at. Only those windows
+    are warped, so the full page is never allocated. Sheets that need the
+    feature-matching fallback are warped whole and cropped. transform is
+    the tags' sheet_transform() when the caller already has it.
+    """
+    if transform is not None:
+        transform_matrix, paper_size = transform
+        if answers_only:
+            return warp_answer_regions(source, transform_matrix, PAPER_LAYOUTS[layout or paper_size]['rois']), paper_size
+        return warp_sheet(source, transform_matrix), paper_size
+
+    if answers_only:
+        try:
+            transform_matrix, paper_size = sheet_transform(detected_tags)
+            return warp_answer_regions(source, transform_matrix, PAPER_LAYOUTS[layout or paper_size]['rois']), paper_size
+        except ValueError as e:
+            log(f"[WARNING] Cannot warp the answer ROIs alone: {e}")
+
+    # Warp image with AprilTag + fallback support
+    # NOTE: Place your blank template at 'blank_template.jpg' or update the path
+    warped_image, paper_size = warp_image(source, template_path='blank_template.jpg', detected_tags=detected_tags)
+    if answers_only:
+        rois = PAPER_LAYOUTS[layout or paper_size or DEFAULT_PAPER_SIZE]['rois']
+        warped_image = {key: warped_image[y1:y2, x1:x2] for key, (x1, y1, x2, y2) in rois.items()}
+    return warped_image, paper_size
+
+
+def locate_encoded_tags(image_bytes, image_path=None):
+    """
+    Tags of an encoded photo, decoding it no larger than each stage needs.
+
+    The tags are read from a reduced decode sized like the coarse pass of
+    locate_tags(). The warp samples from the smallest decode that still
+    covers the DESTINATION_SIZE frame, and the tag corners are scaled to it
+    and refined there. A phone photo of several thousand pixels per side
+    therefore costs one cheap reduced decode plus the decode the warp needs
+    anyway, instead of running every stage at full size.
+
+    Returns:
+        (reduced decode, warp source (the same array when one decode does
+        for both), tags in the warp source's coordinates)
+    """
+    size = image_size(image_bytes)
+    detect_factor = detection_reduction(size) if size else 1
+    warp_factor = min(detect_factor, warp_reduction(size)) if size else 1
+
+    small = decode_image(image_bytes, detect_factor, image_path)
+    if warp_factor == detect_factor:
+        return small, small, locate_tags(small)
+
+    source = decode_image(image_bytes, warp_factor, image_path)
+    detected_tags = detect_apriltags(small, apriltag_detector(), pass_name='coarse')
+    if len(detected_tags) >= 3:
+        log(f"[INFO] Found tags on the 1/{detect_factor} decode, refining corners at 1/{warp_factor}")
+        detected_tags = refine_tag_corners(source, detected_tags, detect_factor // warp_factor)
+    else:
+        log(f"[INFO] Reduced decode found {len(detected_tags)} tags, retrying at 1/{warp_factor}")
+        detected_tags = locate_tags(source, coarse=False)
+    return small, source, detected_tags
+
+
+def set_answer_key(result, answer_key):
+    result.answer_key = checked_answer_key(answer_key)
+
+
+def save_corrected_image(final_image, result, output_dir=CORRECTS_DIR):
+    """Draw the corrected image into result.corrected_image and write it to output_dir, unless that is None"""
+    result.corrected_image = cv2.imencode('.jpg', annotate_sheet(final_image, result))[1].tobytes()
+    if output_dir is not None:
+        result.corrected_image_path = f'{output_dir}/{result.qr_code_data}.jpg'
+        os.makedirs(output_dir, exist_ok=True)
+        with open(result.corrected_image_path, 'wb') as f:
+            f.write(result.corrected_image)
+
+
+def pending_render_path(render_id):
+    # Render ids come back in requests, so they must not be able to name another file
+    if not render_id or set(render_id) - set('0123456789abcdef'):
+        raise ValueError(f"Invalid render id: {render_id!r}")
+    return os.path.join(PENDING_RENDER_DIR, f'{render_id}.npz')
+
+
+def defer_corrected_image(final_image, result, output_dir=CORRECTS_DIR):
+    """
+    Persist what drawing the corrected image needs instead of drawing it.
+
+    corrected_image_path is set to where render_pending() will write it, so
+    callers can store the URL right away, and render_id to what to pass it.
+    """
+    result.corrected_image_path = f'{output_dir}/{result.qr_code_data}.jpg'
+    result.render_pending = True
+    result.render_id = os.urandom(8).hex()
+    os.makedirs(PENDING_RENDER_DIR, exist_ok=True)
+    path = pending_render_path(result.render_id)
+    # Written aside and renamed, so a render running meanwhile never reads half a file
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(
+            f,
+            sheet=shrink_sheet(final_image),
+            bubbles=result.bubbles,
+            answer_key=np.asarray(result.answer_key, dtype=np.int16),
+            qr_code_data=np.array(result.qr_code_data),
+            paper_size=np.array(result.paper_size),
+            corrected_image_path=np.array(result.corrected_image_path),
+        )
+    os.replace(temp_path, path)
+
+
+def render_pending(render_id):
+    """
+    Draw a deferred corrected image and drop its pending state, returns the image path.
+
+    The pending file is renamed to one only this call knows before it is
+    read, so a render running twice, or a rescan writing its own pending
+    file meanwhile, cannot lose or mix up anything. A failed render leaves
+    the file pending again.
+    """
+    path = pending_render_path(render_id)
+    claimed_path = f'{path}.{os.getpid()}.{threading.get_ident()}.rendering'
+    try:
+        os.rename(path, claimed_path)
+    except FileNotFoundError:
+        raise Exception(f"No pending render: {render_id} (already drawn?)")
+
+    try:
+        with np.load(claimed_path, allow_pickle=False) as pending:
+            result = ScanResult(
+                qr_code_data=str(pending['qr_code_data']),
+                paper_size=str(pending['paper_size']),
+                bubbles=pending['bubbles'],
+                corrected_image_path=str(pending['corrected_image_path']),
+            )
+            sheet = pending['sheet']
+            set_answer_key(result, pending['answer_key'].tolist())
+
+        result.question_rows = index_questions(result.bubbles, result.layout['questions'])
+        image_path = result.corrected_image_path
+        os.makedirs(os.path.dirname(image_path) or '.', exist_ok=True)
+        # Same write-then-rename as the pending file, the image may be served meanwhile
+        temp_path = f'{os.path.splitext(image_path)[0]}.{os.getpid()}.{threading.get_ident()}.tmp.jpg'
+        cv2.imwrite(temp_path, annotate_sheet(sheet, result))
+        os.replace(temp_path, image_path)
+    except BaseException:
+        os.replace(claimed_path, path)
+        raise
+    os.remove(claimed_path)
+    return image_path
+
+
+def finish_corrected_image(final_image, result, output_dir, corrected_image):
+    """Draw the corrected image, defer it (corrected_image='deferred') or skip it (False)"""
+    if corrected_image == 'deferred':
+        defer_corrected_image(final_image, result, output_dir)
+    elif corrected_image:
+        save_corrected_image(final_image, result, output_dir)
+
+
+def scan_sheet(image, answer_key, layout=None, output_dir=CORRECTS_DIR, corrected_image=True, concurrent_qr_search=True):
+    """
+    Scan one answer sheet and grade it against answer_key.
+
+    Args:
+        image: Grayscale or BGR image array, the encoded file's bytes, or a
+            path to read it (as grayscale) from
+        answer_key: Correct option per question, 1-4 for A-D
+        layout: 'A4' or 'A5' to override the paper size detected from the tags
+        output_dir: Directory the corrected image is written to, None to
+            only keep it in memory as result.corrected_image
+        corrected_image: False to only grade; then just the answer ROIs are
+            warped and corrected_image_path stays None. 'deferred' to return
+            without drawing it, see defer_corrected_image()
+        concurrent_qr_search: False to keep the whole-photo QR search, when
+            it is needed, on this thread (see whole_photo_qr_search())
+
+    Returns:
+        ScanResult holding all per-sheet state, so calls are safe to run
+        concurrently from several threads or a long-lived worker.
+    """
+    result, warped_image = locate_sheet(image, layout, not corrected_image, concurrent_qr_search)
+    set_answer_key(result, answer_key)
+
+    final_image = convert_to_two_tone(warped_image)
+    read_answers(final_image, result)
+
+    # Save final image
+    finish_corrected_image(final_image, result, output_dir, corrected_image)
+
+    return result
+
+
+def scan_sheet_cached(image, answer_key, cache, layout=None, output_dir=CORRECTS_DIR, corrected_image=True,
+                      concurrent_qr_search=True):
+    """
+    scan_sheet() backed by a ScanCache, so a repeated upload is only regraded.
+
+    The cache holds the vision output (the bubble table and the two-tone
+    sheet). The corrected image is only redrawn from the cached sheet
+    when the answer key differs from the one it was last drawn with.
+    Grading-only scans store no sheet, so a later request for the
+    corrected image scans the photo again. image is a path or the encoded
+    file's bytes.
+    """
+    if isinstance(image, str):
+        image_path, image_bytes = image, read_image_bytes(image)
+    else:
+        image_path, image_bytes = None, image
+    key = content_key(image_bytes, SCANNER_VERSION, layout)
+
+    cached = cache.get(key)
+    if cached is None or (corrected_image and cached[2] is None):
+        result, warped_image = locate_encoded_sheet(image_bytes, layout, image_path, not corrected_image,
+                                                    concurrent_qr_search)
+        set_answer_key(result, answer_key)
+        final_image = convert_to_two_tone(warped_image)
+        read_answers(final_image, result)
+        sheet = None
+        if corrected_image:
+            finish_corrected_image(final_image, result, output_dir, corrected_image)
+            sheet = cv2.imencode('.png', final_image)[1].tobytes()
+
+        cache.put(key, cache_meta(result), result.bubbles.tobytes(), sheet)
+        return result
+
+    meta, bubbles, sheet = cached
+    result = ScanResult(
+        qr_code_data=meta['qRCodeData'],
+        paper_size=meta['paperSize'],
+        bubbles=np.frombuffer(bubbles, dtype=BUBBLE_DTYPE).copy(),
+        corrected_image_path=meta['correctedImageUrl'],
+    )
+    result.question_rows = index_questions(result.bubbles, result.layout['questions'])
+    set_answer_key(result, answer_key)
+
+    if not corrected_image or output_dir is None:
+        result.corrected_image_path = None
+    if corrected_image and output_dir is not None and meta['renderedKey'] == result.answer_key:
+        # Already drawn with this key, hand back that file unless it has gone since
+        try:
+            with open(meta['correctedImageUrl'], 'rb') as f:
+                result.corrected_image = f.read()
+            return result
+        except OSError:
+            pass
+    if corrected_image:
+        final_image = cv2.imdecode(np.frombuffer(sheet, np.uint8), cv2.IMREAD_GRAYSCALE)
+        finish_corrected_image(final_image, result, output_dir, corrected_image)
+        if output_dir is not None:
+            cache.update_meta(key, cache_meta(result))
+
+    return result
+
+
+def cache_meta(result):
+    return {
+        "qRCodeData": result.qr_code_data,
+        "paperSize": result.paper_size,
+        "renderedKey": result.answer_key if result.corrected_image_path else None,
+        "correctedImageUrl": result.corrected_image_path,
+    }
+
+
+def run_scan(image, answers, cache=None, corrected_image=True, output_dir=CORRECTS_DIR, concurrent_qr_search=True):
+    """Scan one answer sheet image (path or encoded bytes), through the cache when there is one, returns its ScanResult"""
+    if cache is not None:
+        return scan_sheet_cached(image, answers, cache, None, output_dir, corrected_image, concurrent_qr_search)
+    return scan_sheet(image, answers, None, output_dir, corrected_image, concurrent_qr_search)
+
+
+# ============================================================================
+# WORKER MODE
+# ============================================================================
+
+def scan_qr_only(image):
+    """
+    Cheap first pass for the two-pass mobile flow: QR payload, paper size and tag ids.
+
+    Works on a half-resolution grayscale decode and stops before the warp,
+    bubble reading and annotation; the QR code is read from the layout's
+    qr_boxes when the tags place the sheet. Full resolution is only decoded
+    when the reduced image is not enough to read the QR or identify the paper.
+    image is a path or the encoded file's bytes.
+    """
+    image_path = image if isinstance(image, str) else None
+    image_bytes = read_image_bytes(image) if image_path else image
+    small = decode_image(image_bytes, 2, image_path)
+
+    tags = detect_apriltags(small, apriltag_detector(), enhance=False)
+    paper_size = detect_paper_size(list(tags))
+
+    transform = tag_transform(tags) if paper_size is not None else None
+    qr_code_data = read_sheet_qr(small, transform) if transform is not None else None
+    if qr_code_data is None:
+        qr_code_data = detect_qr_code(small)
+
+    if qr_code_data is None or paper_size is None:
+        full = decode_image(image_bytes, 1, image_path)
+        if qr_code_data is None:
+            qr_code_data = detect_qr_code(full)
+        if paper_size is None:
+            tags = detect_apriltags(full, apriltag_detector())
+            paper_size = detect_paper_size(list(tags))
+
+    return {
+        "qRCodeData": qr_code_data,
+        "paperSize": paper_size,
+        "tagIds": sorted(int(tag_id) for tag_id in tags),
+    }
+
+
+def handle_request(line, cache=None, payload=None, concurrent_qr_search=True):
+    """
+    Run one JSON-lines request and build its response, errors are reported in-band.
+
+    "mode" selects what to run: "scan" (default, needs "answers"), "qr-only",
+    "extract-key" or "render" (needs the "renderId" of a deferred scan,
+    draws its corrected image). A scan with "correctedImage": false only grades and
+    leaves "correctedImageUrl" null; with "deferred" it returns before the
+    image is drawn and marks the result "renderPending" with its "renderId".
+
+    payload holds the image bytes sent along with the request (see serve()),
+    read in place of the "image" path. concurrent_qr_search=False keeps the
+    scan on this thread, for batch runs that already use every core.
+    """
+    return handle_request_with_image(line, cache, payload, concurrent_qr_search)[0]
+
+
+def handle_request_with_image(line, cache=None, payload=None, concurrent_qr_search=True):
+    """handle_request() that also returns the corrected JPEG when a scan asked for it with "returnImage", else None"""
+    request_id = None
+    try:
+        request = json.loads(line)
+        request_id = request.get('id')
+        mode = request.get('mode', 'scan')
+        image = payload if payload is not None else request.get('image')
+        corrected_jpeg = None
+        if mode == 'scan':
+            result, corrected_jpeg = scan_request(request, image, cache, concurrent_qr_search)
+        elif mode == 'qr-only':
+            result = scan_qr_only(image)
+        elif mode == 'extract-key':
+            result = extract_answer_key(image, concurrent_qr_search=concurrent_qr_search)
+        elif mode == 'render':
+            result = {"correctedImageUrl": render_pending(request['renderId'])}
+        else:
+            raise ValueError(f"Unknown mode: {mode}")
+        return {"id": request_id, "ok": True, "result": result}, corrected_jpeg
+    except Exception as e:
+        return {"id": request_id, "ok": False, "error": str(e)}, None
+
+
+def scan_options(request):
+    """(corrected_image, output_dir, return_image) of a "scan" request, checked for conflicts"""
+    corrected_image = request.get('correctedImage', True)
+    if corrected_image not in (True, False, 'deferred'):
+        raise ValueError(f"Unknown correctedImage: {corrected_image!r}")
+    save_image = request.get('saveImage', True)
+    return_image = request.get('returnImage', False)
+    if return_image and corrected_image is not True:
+        raise ValueError("returnImage needs correctedImage: true")
+    if corrected_image == 'deferred' and not save_image:
+        raise ValueError("Deferred corrected images are always saved")
+    return corrected_image, CORRECTS_DIR if save_image else None, return_image
+
+
+def scan_request(request, image, cache=None, concurrent_qr_search=True):
+    """
+    Run a "scan" request, returns (grading JSON, corrected JPEG or None).
+
+    "saveImage": false keeps the corrected image off disk and "returnImage":
+    true hands it back in memory, announced by "imageBytes" in the result.
+    """
+    corrected_image, output_dir, return_image = scan_options(request)
+    if image is None:
+        raise ValueError("Request has no image")
+    if request.get('answers') is None:
+        raise ValueError("Request has no answers")
+
+    result = run_scan(image, request['answers'], cache, corrected_image, output_dir, concurrent_qr_search)
+    output = generate_json_output(result)
+    if not return_image:
+        return output, None
+    output["imageBytes"] = len(result.corrected_image)
+    return output, result.corrected_image
+
+
+def read_payload(input_stream, line):
+    """
+    The image bytes a request line announces with "imageBytes", None when it has none.
+
+    Raises ValueError, before reading anything, when "imageBytes" is not a
+    byte count, and EOFError when the stream ends before the whole payload.
+    """
+    try:
+        length = json.loads(line).get('imageBytes')
+    except (ValueError, AttributeError):
+        return None  # handle_request() reports the malformed line
+    if length is None:
+        return None
+    if isinstance(length, bool) or not isinstance(length, int) or length < 0:
+        raise ValueError(f"imageBytes must be a byte count, got {length!r}")
+    payload = input_stream.read(length)
+    if len(payload) != length:
+        raise EOFError(f"Expected {length} image bytes, got {len(payload)}")
+    return payload
+
+
+def serve(input_stream, output_stream, cache=None):
+    """
+    Long-lived worker: read one JSON request per line and write one JSON result per line.
+
+    Request:  {"id": ..., "image": "<path>", "answers": [1, 2, ...], "mode": "scan"}
+    Response: {"id": ..., "ok": true, "result": {...}} or {"id": ..., "ok": false, "error": "..."}
+
+    Both streams are binary. Instead of an "image" path a request may give
+    "imageBytes": N and send the encoded image as N raw bytes right after
+    its line. A bad N is reported like any other error; only a stream that
+    ends inside a payload stops the worker (EOFError). A scan with "returnImage": true gets its corrected JPEG back
+    the same way, as "imageBytes" in the result followed by the bytes.
+
+    Heavy imports are paid once at startup, so every request after the first
+    only costs the actual image processing. Deferred corrected images are
+    drawn on a background thread once their response is out, and all of
+    them are drawn before this returns.
+    """
+    renders = queue.Queue()
+    threading.Thread(target=render_worker, args=(renders,), daemon=True).start()
+
+    for line in iter(input_stream.readline, b''):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            payload = read_payload(input_stream, line)
+        except ValueError as e:
+            # Nothing past the line was read, so the next line is still a request
+            response, corrected_jpeg = {"id": json.loads(line).get('id'), "ok": False, "error": str(e)}, None
+        else:
+            response, corrected_jpeg = handle_request_with_image(line, cache, payload)
+        output_stream.write(json.dumps(response).encode('utf-8') + b"\n")
+        if corrected_jpeg is not None:
+            output_stream.write(corrected_jpeg)
+        output_stream.flush()
+        if pending_render(response):
+            renders.put(response['result']['renderId'])
+
+    renders.join()
+
+
+def pending_render(response):
+    """True when a request's response leaves a corrected image to draw"""
+    return response['ok'] and isinstance(response['result'], dict) and response['result'].get('renderPending', False)
+
+
+def render_worker(renders):
+    while True:
+        render_id = renders.get()
+        try:
+            render_pending(render_id)
+        except Exception as e:
+            log(f"[WARNING] Deferred render {render_id} failed: {e}")
+        finally:
+            renders.task_done()
+
+
+def extract_answer_key(image, layout=None, concurrent_qr_search=True):
+    """
+    Read the marked options from a teacher's key sheet.
+
+    Stops after bubble reading: no grading, drawing, correction guide or
+    corrected image is produced.
+    """
+    result, warped_image = locate_sheet(image, layout, True, concurrent_qr_search)
+    read_answers(convert_to_two_tone(warped_image), result)
+    answers, confidence = read_marked_answers(result.fill_matrix)
+    filled_count = (result.fill_matrix >= FILL_THRESHOLD).sum(axis=1)
+
+    return {
+        "qRCodeData": result.qr_code_data,
+        "paperSize": result.paper_size,
+        "Useranswers": answers.tolist(),
+        "confidence": rounded_scores(confidence),
+        "multipleAnswers": (np.flatnonzero(filled_count > 1) + 1).tolist(),
+        "unAnswered": (np.flatnonzero(filled_count == 0) + 1).tolist(),
+    }
+
+
+# ============================================================================
+# STREAMING MODE
+# ============================================================================
+
+def parse_answer_key(line):
+    """Answer key sent on stdin, either a JSON list or {"answers": [...]}"""
+    if not line.strip():
+        raise ValueError("No answer key received")
+    answer_key = json.loads(line)
+    if isinstance(answer_key, dict):
+        answer_key = answer_key.get('answers')
+        if answer_key is None:
+            raise ValueError("No answer key received")
+    return answer_key
+
+
+def scan_streaming(image_path, input_stream, output_stream, layout=None, output_dir=CORRECTS_DIR):
+    """
+    Single-pass scan where the answer key arrives after the QR code is known.
+
+    Writes {"stage": "located", "qRCodeData", "paperSize"} as soon as the
+    QR code is read and the tags place the sheet, before it is warped, so
+    the caller can look up the exam. Warping and bubble reading carry on
+    meanwhile, and the key is read as one line from input_stream.
+    Once both are done, {"stage": "result", ...} carries the usual grading JSON.
+    """
+    def emit(message):
+        output_stream.write(json.dumps(message) + "\n")
+        output_stream.flush()
+
+    # The key may arrive at any point, read it without holding up the vision work
+    key_line = {}
+    reader = threading.Thread(target=lambda: key_line.setdefault('line', input_stream.readline()), daemon=True)
+    reader.start()
+
+    result, placement = find_sheet(image_path, layout, wait_for_qr=True)
+    # Only a sheet the tags could not place needs the warp to tell its paper size
+    placed = result.paper_size is not None
+    if placed:
+        emit({"stage": "located", "qRCodeData": result.qr_code_data, "paperSize": result.paper_size})
+    warped_image = warp_found_sheet(result, placement, layout)
+    if not placed:
+        emit({"stage": "located", "qRCodeData": result.qr_code_data, "paperSize": result.paper_size})
+
+    final_image = convert_to_two_tone(warped_image)
+    read_answers(final_image, result)
+
+    reader.join()
+    set_answer_key(result, parse_answer_key(key_line['line']))
+    save_corrected_image(final_image, result, output_dir)
+
+    output = {"stage": "result"}
+    output.update(generate_json_output(result))
+    emit(output)
+
+
+# ============================================================================
+# DOCUMENT MODE
+# ============================================================================
+
+def document_pages(path):
+    """
+    Pages of a multi-page PDF or TIFF (or any single image) as grayscale arrays, one at a time.
+
+    Pages are decoded or rasterized only when the caller asks for the next
+    one, so a feeder scan of a whole class never has more than the current
+    page in memory. A page that cannot be decoded is yielded as the
+    Exception saying so, letting the caller report it and go on.
+    """
+    with open(path, 'rb') as f:
+        is_pdf = f.read(5) == b'%PDF-'
+    if is_pdf:
+        yield from pdf_pages(path)
+        return
+
+    page_count = cv2.imcount(path)
+    if page_count == 0:
+        raise Exception(f"Error reading image from path: {path}")
+    for index in range(page_count):
+        try:
+            ok, pages = cv2.imreadmulti(path, index, 1, flags=cv2.IMREAD_GRAYSCALE)
+        except cv2.error as e:
+            yield Exception(f"Error reading page {index + 1} of {path}: {e}")
+            continue
+        if ok and pages:
+            yield pages[0]
+        else:
+            yield Exception(f"Error reading page {index + 1} of: {path}")
+
+
+def pdf_pages(path):
+    """PDF pages rasterized in grayscale at the resolution that just covers DESTINATION_SIZE, see document_pages()"""
+    try:
+        import fitz  # PyMuPDF, only PDF input needs it
+    except ImportError:
+        raise Exception("PDF input needs PyMuPDF (pip install pymupdf)")
+
+    with fitz.open(path) as document:
+        for index in range(document.page_count):
+            try:
+                page = document[index]
+                # Page sizes are in points, 72 to the inch
+                short_side, long_side = sorted((page.rect.width / 72, page.rect.height / 72))
+                dpi = max(min(DESTINATION_SIZE) / short_side, max(DESTINATION_SIZE) / long_side)
+                pixmap = page.get_pixmap(dpi=int(np.ceil(dpi)), colorspace=fitz.csGRAY, alpha=False)
+            except Exception as e:
+                yield Exception(f"Error rendering page {index + 1} of {path}: {e}")
+                continue
+            yield np.frombuffer(pixmap.samples, np.uint8).reshape(pixmap.height, pixmap.width)
+
+
+def scan_document(path, answer_key, output_stream, corrected_image=True):
+    """
+    Grade every page of a sheet-feeder scan against one answer key.
+
+    Writes {"page": n, "ok": ..., "result" or "error": ...} per page as soon
+    as it is graded; a page that cannot be read does not stop the rest.
+    """
+    for page_number, page in enumerate(document_pages(path), start=1):
+        try:
+            if isinstance(page, Exception):
+                raise page
+            result = scan_sheet(page, answer_key, corrected_image=corrected_image)
+            response = {"page": page_number, "ok": True, "result": generate_json_output(result)}
+        except Exception as e:
+            response = {"page": page_number, "ok": False, "error": str(e)}
+        output_stream.write(json.dumps(response) + "\n")
+        output_stream.flush()
+
+
+# ============================================================================
+# BATCH MODE
+# ============================================================================
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def init_batch_worker(threads_per_worker):
+    global APRILTAG_THREADS, _cascade_stats
+    APRILTAG_THREADS = threads_per_worker
+    cv2.setNumThreads(threads_per_worker)
+    # Collect this worker's own detection counts (a forked copy would carry
+    # the parent's unsaved ones) and save them when the pool shuts it down,
+    # which skips atexit
+    from multiprocessing.util import Finalize
+    _cascade_stats = None
+    Finalize(None, flush_cascade_stats, exitpriority=10)
+
+
+def run_batch(manifest_path, output_stream, workers=None, cache=None, pipeline=False):
+    """
+    Grade every request in a JSON-lines manifest on a process pool.
+
+    Each manifest line has the same shape as a --serve request. Results are
+    written as soon as each image finishes, so they arrive out of order;
+    use the request "id" to match them up. Deferred corrected images are
+    queued on the pool behind the remaining scans. With pipeline=True the
+    batch runs in this process instead, see run_pipeline().
+    """
+    with open(manifest_path) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if pipeline and workers is not None:
+        raise ValueError("Workers do not apply to a pipelined batch, its stages are sized by PIPELINE_THREADS")
+    if not lines:
+        return
+    if pipeline:
+        run_pipeline(lines, output_stream, cache)
+        return
+
+    cores = available_cores()
+    workers = max(1, min(workers or cores, len(lines)))
+    threads_per_worker = max(1, cores // workers)
+    log(f"[INFO] Batch of {len(lines)} images on {workers} workers x {threads_per_worker} threads")
+
+    # Only batch runs pay for the process pool machinery
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    with ProcessPoolExecutor(workers, initializer=init_batch_worker, initargs=(threads_per_worker,)) as pool:
+        # Every core already has a sheet, so no scan needs a helper thread
+        futures = {pool.submit(handle_request, line, cache, None, False): line for line in lines}
+        renders = {}
+        for future in as_completed(futures):
+            try:
+                response = future.result()
+            except Exception as e:
+                # A worker died (e.g. a native crash); report it instead of hanging the batch
+                try:
+                    request_id = json.loads(futures[future]).get('id')
+                except (json.JSONDecodeError, AttributeError):
+                    request_id = None
+                response = {"id": request_id, "ok": False, "error": f"Worker failed: {e!r}"}
+            output_stream.write(json.dumps(response) + "\n")
+            output_stream.flush()
+            if pending_render(response):
+                render_id = response['result']['renderId']
+                renders[pool.submit(render_pending, render_id)] = render_id
+
+        for future in as_completed(renders):
+            try:
+                future.result()
+            except Exception as e:
+                log(f"[WARNING] Deferred render {renders[future]} failed: {e!r}")
+
+
+class PipelineItem:
+    """One request on its way through run_pipeline(); response is set once it is done or failed"""
+
+    def __init__(self, line):
+        self.line = line
+        self.request_id = None
+        self.request = None
+        self.options = None
+        self.result = None
+        self.image = None
+        self.response = None
+
+
+def pipeline_stage(work, inbox, outbox, threads):
+    """
+    Start threads that pass items from inbox through work() to outbox.
+
+    Items that already have a response are forwarded untouched, and an
+    exception becomes the item's error response. None in inbox stops the
+    stage; returns the threads so the caller can join them.
+    """
+    def loop():
+        while True:
+            item = inbox.get()
+            if item is None:
+                inbox.put(None)  # for the stage's other threads
+                return
+            if item.response is None:
+                try:
+                    work(item)
+                except Exception as e:
+                    item.response = {"id": item.request_id, "ok": False, "error": str(e)}
+            outbox.put(item)
+
+    workers = [threading.Thread(target=loop, daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def run_pipeline(lines, output_stream, cache=None):
+    """
+    Grade a batch in this process as three threaded stages joined by bounded queues.
+
+    locate (decode, QR, tags, warp) -> read (two-tone, bubbles) -> finish
+    (corrected image, response). OpenCV, the AprilTag detector and zbar
+    release the GIL, so one image decodes while the previous one is read
+    and the one before that is encoded. Requests the stages do not split
+    (other modes, or any scan when there is a cache) run whole in the
+    locate stage.
+    """
+    pending_renders = []
+
+    def locate(item):
+        item.request = json.loads(item.line)
+        item.request_id = item.request.get('id')
+        if item.request.get('mode', 'scan') != 'scan' or cache is not None:
+            # The stages already keep the cores busy, scans get no helper threads
+            item.response = handle_request(item.line, cache, concurrent_qr_search=False)
+            return
+        item.options = scan_options(item.request)
+        if 'image' not in item.request:
+            raise ValueError("Request has no image")
+        if item.request.get('answers') is None:
+            raise ValueError("Request has no answers")
+        item.result, item.image = locate_sheet(item.request['image'], None, not item.options[0], False)
+        set_answer_key(item.result, item.request['answers'])
+
+    def read(item):
+        item.image = convert_to_two_tone(item.image)
+        read_answers(item.image, item.result)
+
+    def finish(item):
+        corrected_image, output_dir, _ = item.options
+        finish_corrected_image(item.image, item.result, output_dir, corrected_image)
+        item.image = None
+        item.response = {"id": item.request_id, "ok": True, "result": generate_json_output(item.result)}
+
+    def write_responses(outbox):
+        for item in iter(outbox.get, None):
+            output_stream.write(json.dumps(item.response) + "\n")
+            output_stream.flush()
+            if pending_render(item.response):
+                pending_renders.append(item.response['result']['renderId'])
+
+    stages = [('locate', locate), ('read', read), ('finish', finish)]
+    queues = [queue.Queue(PIPELINE_QUEUE_SIZE) for _ in range(len(stages) + 1)]
+    log(f"[INFO] Pipelined batch of {len(lines)} images, threads per stage {PIPELINE_THREADS}")
+
+    stage_threads = [
+        pipeline_stage(work, queues[index], queues[index + 1], PIPELINE_THREADS[name])
+        for index, (name, work) in enumerate(stages)
     ]
-    filled_points = 0
+    # Responses are written as items come out of the last stage
+    writer = threading.Thread(target=write_responses, args=(queues[-1],), daemon=True)
+    writer.start()
 
-    for point in points_to_check:
-        if 0 <= point[0] < image.shape[1] and 0 <= point[1] < image.shape[0]:
-            if image[point[1], point[0]] < threshold:
-                filled_points += 1
+    for line in lines:
+        queues[0].put(PipelineItem(line))
+    # Stop each stage once the one before it has drained
+    queues[0].put(None)
+    for index, threads in enumerate(stage_threads):
+        for thread in threads:
+            thread.join()
+        queues[index + 1].put(None)
+    writer.join()
 
-    return filled_points >= len(points_to_check) // 2
+    for render_id in pending_renders:
+        try:
+            render_pending(render_id)
+        except Exception as e:
+            log(f"[WARNING] Deferred render {render_id} failed: {e}")
 
 
 # ============================================================================
 # MAIN EXECUTION
 # ============================================================================
 
-if len(sys.argv) != 3:
-    raise ValueError("Two inputs required: 1) Image path, 2) Correct answers list")
+def main(argv):
+    global DETECTION_STATS_PATH
+    parser = argparse.ArgumentParser(description="Scan and grade AprilTag answer sheets")
+    parser.add_argument('image', nargs='?', help="Image path")
+    parser.add_argument('answers', nargs='?', help="Correct answers as a JSON list")
+    parser.add_argument('--serve', action='store_true', help="Process JSON-lines requests from stdin")
+    parser.add_argument('--qr-only', action='store_true', help="Only read the QR code, paper size and tag ids")
+    parser.add_argument('--extract-key', action='store_true', help="Read the marked options of an answer-key sheet")
+    parser.add_argument('--no-corrected-image', action='store_true',
+                        help="Only grade: warp just the answer areas and write no corrected image")
+    parser.add_argument('--defer-render', action='store_true',
+                        help="Return the grading before the corrected image is drawn (draw it later with --render)")
+    parser.add_argument('--render', metavar='RENDER_ID', help="Draw the deferred corrected image of a sheet")
+    parser.add_argument('--document', action='store_true',
+                        help="The image is a multi-page PDF or TIFF; grade every page against the answers")
+    parser.add_argument('--stream', action='store_true', help="Report the QR code first, then read the answer key from stdin")
+    parser.add_argument('--batch', metavar='MANIFEST', help="Process a JSON-lines manifest on a process pool")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Run --batch as threaded stages in this process instead of a process pool")
+    parser.add_argument('--workers', type=int,
+                        help="Batch pool size (default: available cores), not used with --pipeline")
+    parser.add_argument('--cache', metavar='PATH', help="SQLite file caching scans by image content")
+    parser.add_argument('--cache-max-mb', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help="Evict least recently used cache entries above this size")
+    parser.add_argument('--regrade', metavar='RECORDS', help="Regrade stored fill matrices (JSON lines) against --key")
+    parser.add_argument('--key', help="Answer key as a JSON list, used with --regrade")
+    parser.add_argument('--detection-stats', metavar='PATH', default=DETECTION_STATS_PATH,
+                        help="JSON file of preprocessing success counts ('' to keep them in memory)")
+    args = parser.parse_args(argv[1:])
+    DETECTION_STATS_PATH = args.detection_stats or None
+    cache = ScanCache(args.cache, args.cache_max_mb * 1024 * 1024) if args.cache else None
 
-image_path = sys.argv[1]
-correct_answers_str = sys.argv[2]
+    if args.serve:
+        log("[INFO] Scanner worker ready")
+        serve(sys.stdin.buffer, sys.stdout.buffer, cache)
+        return
 
-try:
-    correct_answers = json.loads(correct_answers_str)
-except json.JSONDecodeError:
-    raise ValueError("Invalid format for correct answers")
+    if args.batch:
+        run_batch(args.batch, sys.stdout, workers=args.workers, cache=cache, pipeline=args.pipeline)
+        return
 
-answer_mapping = {1: 'A', 2: 'B', 3: 'C', 4: 'D'}
-mapped_answers = [answer_mapping[ans] for ans in correct_answers]
+    if args.qr_only:
+        if args.image is None:
+            raise ValueError("Image path required")
+        print(json.dumps(scan_qr_only(args.image)))
+        return
 
-image = read_local_image(image_path)
-qr_code_data = detect_qr_code(image)
+    if args.extract_key:
+        if args.image is None:
+            raise ValueError("Image path required")
+        print(json.dumps(extract_answer_key(args.image)))
+        return
 
-# Warp image with AprilTag + fallback support
-# NOTE: Place your blank template at 'blank_template.jpg' or update the path
-warped_image = warp_image(image, template_path='blank_template.jpg')
+    if args.render:
+        print(json.dumps({"correctedImageUrl": render_pending(args.render)}))
+        return
 
-if warped_image is not None:
-    two_tone_image = convert_to_two_tone(warped_image)
-    final_image = two_tone_image
-    pil_image = Image.fromarray(final_image)
+    if args.stream:
+        if args.image is None:
+            raise ValueError("Image path required")
+        scan_streaming(args.image, sys.stdin, sys.stdout)
+        return
 
-# Detect circles in each ROI
-detected_circles = {}
-for key, roi in rois.items():
-    min_radius = 33 // 2 if paper_size == 'A4' else 42 // 2 if paper_size == 'A5' else 33 // 2
-    _, circles = process_roi(final_image, roi, min_radius=min_radius)
-    if circles is not None:
-        detected_circles[key] = circles
-
-# Process circles using spatial positioning
-circle_mappings = {}
-for roi_key, circles in detected_circles.items():
-    roi_index = int(roi_key.split('_')[-1])
-    circle_mappings[roi_key] = sort_circles_spatially(circles, roi_index)
-
-# Initialize dataframe
-if paper_size == 'A4':
-    df = pd.DataFrame({'Option': ['N'] * 120}, index=range(1, 121))
-elif paper_size == 'A5':
-    df = pd.DataFrame({'Option': ['N'] * 60}, index=range(1, 61))
-else:
-    df = pd.DataFrame({'Option': ['N'] * 120}, index=range(1, 121))
-
-filled_circles_count = {}
-
-# Process filled circles
-for roi_key, circle_map in circle_mappings.items():
-    x_offset, y_offset = rois[roi_key][0], rois[roi_key][1]
-    
-    for circle_key, (question_number, option, circle) in circle_map.items():
-        x, y, r = circle
-        adjusted_x, adjusted_y = x + x_offset, y + y_offset
-        
-        if is_filled_circle(final_image, (adjusted_x, adjusted_y, r)):
-            if question_number not in filled_circles_count:
-                filled_circles_count[question_number] = 0
-            filled_circles_count[question_number] += 1
-            
-            if filled_circles_count[question_number] > 1:
-                df.at[question_number, 'Option'] = 'W'  # Multiple answers
-            else:
-                df.at[question_number, 'Option'] = option
-
-# Visualization and correction
-circle_radius = 20 if paper_size == 'A4' else 25 if paper_size == 'A5' else 20
-final_image_color = cv2.cvtColor(final_image, cv2.COLOR_GRAY2BGR)
-total_questions = len(correct_answers)
-square_size = 60 if paper_size == 'A4' else 80 if paper_size == 'A5' else 60
-half_square = square_size // 2
-
-# Draw correct answer circles (green)
-for roi_key, circle_map in circle_mappings.items():
-    x_offset, y_offset = rois[roi_key][0], rois[roi_key][1]
-    
-    for circle_key, (question_number, option, circle) in circle_map.items():
-        if question_number <= total_questions:
-            x, y, r = circle
-            adjusted_x, adjusted_y = x + x_offset, y + y_offset
-            correct_answer = mapped_answers[question_number - 1]
-            
-            if correct_answer == option:
-                cv2.circle(final_image_color, (adjusted_x, adjusted_y), 
-                          circle_radius, (0, 255, 0), 3)
-
-# Draw yellow circles for unanswered questions
-circle_radius_yellow = 10 if paper_size == 'A4' else 15 if paper_size == 'A5' else 10
-
-for question_number in range(1, total_questions + 1):
-    if filled_circles_count.get(question_number, 0) == 0:
-        correct_answer = mapped_answers[question_number - 1]
-        
-        # Find the correct answer circle
-        for roi_key, circle_map in circle_mappings.items():
-            x_offset, y_offset = rois[roi_key][0], rois[roi_key][1]
-            
-            for circle_key, (q_num, option, circle) in circle_map.items():
-                if q_num == question_number and option == correct_answer:
-                    x, y, r = circle
-                    adjusted_x, adjusted_y = x + x_offset, y + y_offset
-                    cv2.circle(final_image_color, (adjusted_x, adjusted_y), 
-                              circle_radius_yellow, (0, 255, 255), -1)
-                    break
-
-# Draw rectangles for filled answers
-for roi_key, circle_map in circle_mappings.items():
-    x_offset, y_offset = rois[roi_key][0], rois[roi_key][1]
-    
-    for circle_key, (question_number, option, circle) in circle_map.items():
-        if question_number <= total_questions:
-            x, y, r = circle
-            adjusted_x, adjusted_y = x + x_offset, y + y_offset
-            
-            if is_filled_circle(final_image, (adjusted_x, adjusted_y, r)):
-                if filled_circles_count[question_number] > 1:
-                    # Multiple answers - yellow rectangle
-                    cv2.rectangle(final_image_color, (adjusted_x-half_square, adjusted_y-half_square), 
-                                 (adjusted_x+half_square, adjusted_y+half_square), (0, 255, 255), 3)
-                else:
-                    correct_answer = mapped_answers[question_number - 1]
-                    if correct_answer == df.at[question_number, 'Option']:
-                        # Correct answer - green rectangle
-                        cv2.rectangle(final_image_color, (adjusted_x-half_square, adjusted_y-half_square), 
-                                     (adjusted_x+half_square, adjusted_y+half_square), (55, 155, 55), 3)
-                    else:
-                        # Wrong answer - red rectangle
-                        cv2.rectangle(final_image_color, (adjusted_x-half_square, adjusted_y-half_square), 
-                                     (adjusted_x+half_square, adjusted_y+half_square), (35, 35, 200), 3)
-
-# Add correction guide
-correction_guide = cv2.imread('correction_guide.jpg')
-
-if paper_size == 'A4':
-    upper_left = (1180, 641)
-    lower_right = (1570, 955)
-elif paper_size == 'A5':
-    upper_left = (1570, 700)
-    lower_right = (2160, 1160)
-else:
-    upper_left = (1180, 641)
-    lower_right = (1570, 955)
-
-correction_guide_resized = cv2.resize(correction_guide, (lower_right[0] - upper_left[0], lower_right[1] - upper_left[1]))
-final_image_color[upper_left[1]:lower_right[1], upper_left[0]:lower_right[0]] = correction_guide_resized
-
-# Save final image
-resized_image = cv2.resize(final_image_color, (1000, 1436))
-random_number = random.randint(1000000000, 9999999999)
-final_image_path = f'../public/uploads/corrects/{qr_code_data}.jpg'
-cv2.imwrite(final_image_path, resized_image)
-
-# Generate and print JSON output
-json_result = generate_json_output(qr_code_data)
-print(json_result)
\ No newline at end of file
+    if args.regrade:
+        if args.key is None:
+            raise ValueError("--regrade needs --key")
+        with open(args.regrade) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        for response in regrade(records, json.loads(args.key)):
+            sys.stdout.write(json.dumps(response) + "\n")
+        return
+
+    if args.image is None or args.answers is None:
+        raise ValueError("Two inputs required: 1) Image path, 2) Correct answers list")
+
+    try:
+        answers = json.loads(args.answers)
+    except json.JSONDecodeError:
+        raise ValueError("Invalid format for correct answers")
+
+    # Generate and print JSON output
+    corrected_image = False if args.no_corrected_image else 'deferred' if args.defer_render else True
+    if args.document:
+        scan_document(args.image, answers, sys.stdout, corrected_image)
+        return
+
+    print(json.dumps(generate_json_output(run_scan(args.image, answers, cache, corrected_image))))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -5,7 +5,7 @@ Answer-sheet scanner & corrector
 Readable-symbols edition  (Unicode-free)
 """
 
-import cv2, sys, json, random, numpy as np, pandas as pd
+import cv2, sys, json, numpy as np
 import cv2.aruco as aruco
 from pyzbar.pyzbar import decode
 
@@ -185,8 +185,8 @@ for key,roi in rois.items():
     cir=detect_circles(crop,rmin)
     if cir is not None: detected[key]=sort_circles(cir,'q')
 
-# ---- DF & counts
-df=pd.DataFrame({'Option':['N']*total_q},index=range(1,total_q+1))
+# ---- marked options & counts
+marked={}   # q -> marked option, 'W' for several
 filled_cnt={}
 
 for sec,ids in detected.items():
@@ -197,8 +197,8 @@ for sec,ids in detected.items():
         q,opt=q_no_opt(cid)
         if fill:
             filled_cnt[q]=filled_cnt.get(q,0)+1
-            if filled_cnt[q]==1: df.at[q,'Option']=opt
-            else: df.at[q,'Option']='W'
+            if filled_cnt[q]==1: marked[q]=opt
+            else: marked[q]='W'
 
 # ──────────────────────────────────────────────────────────────────────────────
 #                       VISUAL ANNOTATION
@@ -258,7 +258,7 @@ for i,(shape,text,cat) in enumerate(legend):
     cv2.putText(sheet_color,text,(cx+55,cy+8),
                 FONT,FONT_SMALL,(0,0,0),1,cv2.LINE_AA)
 
-score=sum(df.at[q,'Option']==mapped_answers[q-1] for q in range(1,total_q+1))
+score=sum(marked.get(q,'N')==mapped_answers[q-1] for q in range(1,total_q+1))
 cv2.putText(sheet_color,f"{score}/{total_q} correct",
             (px+20,py+panel_h-30),FONT,1.2,(0,0,0),2,cv2.LINE_AA)
 
@@ -275,7 +275,7 @@ def make_json():
     right,wrong,multi,unans,user=[],[],[],[],[]
     to_num={'A':1,'B':2,'C':3,'D':4}
     for q in range(1,total_q+1):
-        opt=df.at[q,'Option']; user.append(to_num.get(opt,0))
+        opt=marked.get(q,'N'); user.append(to_num.get(opt,0))
         if filled_cnt.get(q,0)>1: multi.append(q)
         elif filled_cnt.get(q,0)==0: unans.append(q)
         elif opt==mapped_answers[q-1]: right.append(q)
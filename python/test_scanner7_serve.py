@@ -0,0 +1,104 @@
+"""
+Framing of scanner7's --serve protocol: JSON request lines, each optionally
+followed by "imageBytes" raw bytes, answered by JSON lines that may carry a
+corrected JPEG the same way.
+
+Run from the python/ directory with `python -m pytest test_scanner7_serve.py`.
+"""
+import io
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+import scanner7
+from scan_cache import ScanCache, content_key
+
+
+@pytest.fixture(autouse=True)
+def no_stats_file(monkeypatch):
+    monkeypatch.setattr(scanner7, 'DETECTION_STATS_PATH', None)
+    monkeypatch.setattr(scanner7, '_cascade_stats', None)
+
+
+def frame(request, payload=b''):
+    return json.dumps(request).encode('utf-8') + b"\n" + payload
+
+
+def serve(*frames, cache=None):
+    """Feed frames to serve(), returns [(response, image bytes or None), ...]"""
+    output = io.BytesIO()
+    scanner7.serve(io.BytesIO(b''.join(frames)), output, cache)
+    output.seek(0)
+    responses = []
+    for line in iter(output.readline, b''):
+        response = json.loads(line)
+        length = response.get('result', {}).get('imageBytes') if response['ok'] else None
+        responses.append((response, output.read(length) if length is not None else None))
+    return responses
+
+
+@pytest.mark.parametrize('length', ["abc", -1, 1.5, True, [3]])
+def test_bad_image_bytes_is_reported_in_band(length):
+    responses = serve(
+        frame({"id": 1, "imageBytes": length, "answers": [1]}),
+        frame({"id": 2, "mode": "render", "renderId": "0123abcd"}),
+    )
+    assert [response['id'] for response, _ in responses] == [1, 2]
+    assert not responses[0][0]['ok']
+    assert 'imageBytes' in responses[0][0]['error']
+    # The second request was read as a request, not swallowed as payload
+    assert 'No pending render' in responses[1][0]['error']
+
+
+def test_payload_is_consumed_before_the_next_request():
+    garbage = b'not an image\n{"id": 99}\n'
+    responses = serve(
+        frame({"id": 1, "imageBytes": len(garbage), "answers": [1]}, garbage),
+        frame({"id": 2, "mode": "nope"}),
+    )
+    assert [response['id'] for response, _ in responses] == [1, 2]
+    assert not responses[0][0]['ok']
+    assert responses[1][0]['error'] == "Unknown mode: nope"
+
+
+def test_truncated_payload_stops_the_worker():
+    with pytest.raises(EOFError):
+        serve(frame({"id": 1, "imageBytes": 100, "answers": [1]}, b'short'))
+
+
+def test_malformed_line_is_reported_in_band():
+    responses = serve(b'{not json\n', frame({"id": 2, "mode": "nope"}))
+    assert not responses[0][0]['ok'] and responses[0][0]['id'] is None
+    assert responses[1][0]['id'] == 2
+
+
+def test_return_image_from_cache_hit(tmp_path):
+    image_bytes = b'photo already scanned once'
+    corrected_path = tmp_path / 'corrected.jpg'
+    corrected_path.write_bytes(b'corrected jpeg')
+
+    cache = ScanCache(str(tmp_path / 'cache.sqlite'))
+    meta = {
+        "qRCodeData": "123",
+        "paperSize": "A5",
+        "renderedKey": [1, 2],
+        "correctedImageUrl": str(corrected_path),
+    }
+    sheet = cv2.imencode('.png', np.zeros((8, 8), np.uint8))[1].tobytes()
+    cache.put(content_key(image_bytes, scanner7.SCANNER_VERSION, None), meta,
+              np.zeros(0, scanner7.BUBBLE_DTYPE).tobytes(), sheet)
+
+    [(response, image)] = serve(
+        frame({"id": 1, "imageBytes": len(image_bytes), "answers": [1, 2], "returnImage": True}, image_bytes),
+        cache=cache,
+    )
+    assert response['ok'], response
+    assert response['result']['imageBytes'] == len(b'corrected jpeg')
+    assert image == b'corrected jpeg'
+
+
+def test_scan_without_answers_is_reported_in_band():
+    [(response, _)] = serve(frame({"id": 1, "image": "sheet.jpg"}))
+    assert response == {"id": 1, "ok": False, "error": "Request has no answers"}